@@ -0,0 +1,224 @@
+import contextlib
+import datetime
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from fixations import png_size
+from videowriter import CODECS
+
+MANIFEST_NAME = "reproject_manifest.json"
+# Roughly how many frames a rendering session holds at once, in the screenshot cache, the writer queue and the drawing
+FRAMES_PER_RENDER = 64
+# Memory a worker takes before it holds anything of a session e.g. numpy, cv2 and the parsed montages
+BASE_MEMORY = 300 * 2 ** 20
+# The analysis holds the decoded gaze log, which takes several times the space of the text
+ANALYSIS_MEMORY_PER_LOG_BYTE = 10
+
+
+def find_sessions(root):
+    """
+    :param root: A mirror directory, or any directory above the recordings
+    :return: Every directory under root with a uilog/ui_log.txt, sorted
+    """
+    sessions = []
+    for directory, subdirectories, files in os.walk(root):
+        if os.path.exists(os.path.join(directory, 'uilog', 'ui_log.txt')):
+            sessions.append(directory)
+            # A recording does not hold other recordings
+            subdirectories.clear()
+    return sorted(sessions)
+
+
+def session_inputs(directory):
+    return [os.path.join(directory, 'uilog', 'ui_log.txt'), os.path.join(directory, 'gaze_data.txt')]
+
+
+def session_output(directory, analyse, video_codec):
+    if analyse:
+        return os.path.join(directory, 'fixations.npz')
+    return os.path.join(directory, 'uilog', f"visualise{CODECS[video_codec][1]}")
+
+
+def is_up_to_date(directory, output_path):
+    """
+    :return: True if the output exists and was written after every input of the session last changed
+    """
+    if not os.path.exists(output_path):
+        return False
+    inputs = [os.path.getmtime(path) for path in session_inputs(directory) if os.path.exists(path)]
+    return os.path.getmtime(output_path) > max(inputs, default=0)
+
+
+def session_memory(directory, analyse):
+    """
+    :return: A rough guess at the most memory in bytes processing the session takes
+    """
+    if analyse:
+        gaze_log_path = os.path.join(directory, 'gaze_data.txt')
+        gaze_log_size = os.path.getsize(gaze_log_path) if os.path.exists(gaze_log_path) else 0
+        return BASE_MEMORY + gaze_log_size * ANALYSIS_MEMORY_PER_LOG_BYTE
+    image_path = os.path.join(directory, 'uilog', 'screenshots', '0.png')
+    if not os.path.exists(image_path):
+        # It will fail straight away
+        return BASE_MEMORY
+    width, height = png_size(image_path)
+    return BASE_MEMORY + width * height * 3 * FRAMES_PER_RENDER
+
+
+def available_memory():
+    """
+    The memory new processes can use without swapping. On Linux this is MemAvailable from /proc/meminfo, which counts
+    the page cache that can be given back, e.g. from reading large edf files, as well as the free memory. Elsewhere the
+    free physical memory from sysconf is used, which leaves out the page cache so it errs on the low side.
+    :return: The available memory in bytes, or None where it can not be found e.g. on Windows
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def pool_size(workers, memory_needed):
+    """
+    :param workers: The most processes to use e.g. the number of CPUs
+    :param memory_needed: The memory one process needs in bytes
+    :return: The number of processes that fit in the free memory, at least one
+    """
+    memory = available_memory()
+    if memory is not None and memory_needed > 0:
+        workers = min(workers, memory // memory_needed)
+    return max(1, int(workers))
+
+
+def process_session(directory, analyse, options):
+    """
+    Produce the video or the fixation results of one session, in a worker process. What would be printed goes to
+    reproject.log in the session's uilog directory so that the sessions running together do not interleave.
+    :param directory: The session directory
+    :param analyse: Write the fixation results rather than a video
+    :param options: Keyword arguments for PlayBack, or analyse_session if analyse
+    :return: The path of the output
+    """
+    with open(os.path.join(directory, 'uilog', 'reproject.log'), 'w') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        if analyse:
+            from fixations import analyse_session
+            analyse_session(directory, **options)
+            return session_output(directory, True, None)
+        from playback_analysis import PlayBack
+        playback = PlayBack(directory, video=True, **options)
+        playback.finish()
+        if playback.error is not None:
+            raise playback.error
+        return playback.video_path
+
+
+class Manifest:
+
+    def __init__(self, root, kind):
+        """
+        Records how each session of a batch went in a JSON file at the root of the batch, so an interrupted batch can be
+        started again and carry on from where it was
+        :param root: The directory the batch was run on
+        :param kind: What the batch produces, "video" or "analysis", each is recorded separately in the same file
+        """
+        self.root = root
+        self.kind = kind
+        self.path = os.path.join(root, MANIFEST_NAME)
+        self.batches = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.batches = json.load(f)
+            except Exception:
+                print(f"Could not read the manifest at {self.path}, starting a new one")
+                self.batches = {}
+        self.sessions = self.batches.setdefault(kind, {})
+
+    def key(self, directory):
+        return os.path.relpath(directory, self.root).replace(os.sep, '/')
+
+    def is_done(self, directory, output_path):
+        """
+        :return: True if the session finished and its output has not gone out of date since. A session with an output
+                 but no entry was processed outside of a batch, it counts as done if the output is up to date.
+        """
+        entry = self.sessions.get(self.key(directory))
+        if entry is not None and entry['status'] != 'done':
+            return False
+        return is_up_to_date(directory, output_path)
+
+    def record(self, directory, status, output_path=None, error=None):
+        entry = {'status': status, 'time': datetime.datetime.now().isoformat(timespec='seconds')}
+        if output_path is not None:
+            entry['output'] = output_path
+        if error is not None:
+            entry['error'] = error
+        self.sessions[self.key(directory)] = entry
+        self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.batches, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def process_all(root, analyse=False, workers=None, signals=False, persist_montages=False, path_map=None,
+                video_codec='mp4v', video_scale=1.0, video_fps=60):
+    """
+    Produce the video, or the fixation results, of every session under a mirror directory. Sessions run side by side
+    on a pool of processes sized by the CPUs and the free memory, each session on one process, so the pool is not
+    nested inside the segmented rendering of single sessions. Sessions whose output is newer than their logs are
+    skipped, and the outcome of each is kept in a manifest at the root. The batch never stops to ask for an edf, a
+    session that needs one that can not be found fails and the rest carry on.
+    :param root: The mirror directory
+    :param analyse: Write the fixation results rather than a video
+    :param workers: The most processes to use, the number of CPUs if None
+    :return: The Manifest
+    """
+    assert (os.path.exists(root)), f"The specified input directory is invalid {root}"
+    manifest = Manifest(root, 'analysis' if analyse else 'video')
+    sessions = find_sessions(root)
+    pending = [s for s in sessions if not manifest.is_done(s, session_output(s, analyse, video_codec))]
+    print(f"Found {len(sessions)} sessions under {root}, {len(sessions) - len(pending)} already done")
+    if not pending:
+        return manifest
+
+    # The longest sessions go first so the pool is not left waiting on one at the end
+    pending.sort(key=lambda s: os.path.getsize(session_inputs(s)[1]) if os.path.exists(session_inputs(s)[1]) else 0,
+                 reverse=True)
+    workers = pool_size(workers or os.cpu_count() or 1, max(session_memory(s, analyse) for s in pending))
+    print(f"Processing {len(pending)} sessions on {workers} processes")
+
+    if analyse:
+        options = dict(persist_montages=persist_montages, path_map=path_map, headless=True)
+    else:
+        options = dict(signals=signals, persist_montages=persist_montages, path_map=path_map, headless=True,
+                       video_codec=video_codec, video_scale=video_scale, video_fps=video_fps)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for directory in pending:
+            manifest.record(directory, 'running')
+            futures[pool.submit(process_session, directory, analyse, options)] = directory
+        for count, future in enumerate(as_completed(futures), 1):
+            directory = futures[future]
+            try:
+                output_path = future.result()
+            except Exception as e:
+                error = "".join(traceback.format_exception_only(type(e), e)).strip()
+                manifest.record(directory, 'failed', error=error)
+                print(f"({count}/{len(pending)}) Failed {directory}: {error}")
+            else:
+                manifest.record(directory, 'done', output_path)
+                print(f"({count}/{len(pending)}) Done {directory}")
+    return manifest
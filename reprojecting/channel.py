@@ -1,30 +1,23 @@
-from scipy import signal
-from lxml import etree
-import os
-from io import StringIO, BytesIO
 from filter_class import FidFilter
 
 
 class Channel:
 
-    def __init__(self, channel_id, label, factor, voltspercm, screen_offset, polarity, data=None):
+    def __init__(self, channel_id, label, factor, voltspercm, screen_offset, polarity, filter_cnt=None, data=None):
         self.id = channel_id
         self.label = label
         self.factor = factor
         self.voltspercm = voltspercm
         self.screen_offset = screen_offset
         self.polarity = polarity
+        self.filter_cnt = filter_cnt
         self.fid_filters = []
         self.data = data
         self.baseline = None
 
-    def update_baseline(self, graph_height, num_channels, graph_top):
-        step = graph_height / (num_channels + 1)
-        self.baseline = step
-        self.baseline += (self.id * int(step)) + (int(graph_top) + int(float(self.screen_offset)))
-        self.baseline = int(self.baseline)
-
     def apply_filters(self):
+        # scipy takes most of a second to import, so only pay for it when filtering
+        from scipy import signal
         for f in self.fid_filters:
             if f.model == 0:
                 btype = 'lowpass'
@@ -38,12 +31,14 @@ class Channel:
 
     def butter_lowpass_filter(self, data, cutoff_freq, nyq_freq, order=4):
         # Source: https://github.com/guillaume-chevalier/filtering-stft-and-laplace-transform
+        from scipy import signal
         b, a = self.butter_lowpass(cutoff_freq, nyq_freq, order=order)
         y = signal.filtfilt(b, a, data)
         return y
 
     @staticmethod
     def butter_lowpass(cutoff, nyq_freq, order=4):
+        from scipy import signal
         normal_cutoff = float(cutoff) / nyq_freq
         b, a = signal.butter(order, [normal_cutoff], btype='lowpass')
         return b, a
@@ -0,0 +1,105 @@
+import numpy
+
+
+class ChannelBuffer:
+
+    def __init__(self):
+        """
+        Holds the current page of every channel as a ring in one flat float64 array. Channel i has a region of twice
+        its page length starting at offsets[i], and every sample is written to both halves of the region, so the page
+        is always the contiguous slice starting at heads[i] however far the ring has turned. Scrolling moves the head
+        and only the samples that came into view are read, the rest of the page stays where it is.
+        """
+        self.data = numpy.empty(0, dtype=numpy.float64)
+        self.offsets = numpy.zeros(0, dtype=numpy.int64)
+        self.lengths = numpy.zeros(0, dtype=numpy.int64)
+        self.heads = numpy.zeros(0, dtype=numpy.int64)
+        self.positions = numpy.zeros(0, dtype=numpy.int64)
+        self.filled = numpy.zeros(0, dtype=bool)
+
+    def allocate(self, lengths):
+        """
+        Lay out the channels in the buffer. Nothing changes if the page lengths are the same as before, so the pages
+        already held can be scrolled. The storage is only reallocated when it needs to grow.
+        :param lengths: The number of samples to hold for each channel
+        """
+        lengths = numpy.asarray(lengths, dtype=numpy.int64)
+        if numpy.array_equal(lengths, self.lengths):
+            return
+        self.lengths = lengths
+        self.offsets = numpy.zeros(len(self.lengths), dtype=numpy.int64)
+        if len(self.lengths) > 1:
+            self.offsets[1:] = numpy.cumsum(2 * self.lengths[:-1])
+        total = int(2 * self.lengths.sum())
+        if total > self.data.size:
+            self.data = numpy.empty(total, dtype=numpy.float64)
+        self.heads = numpy.zeros(len(self.lengths), dtype=numpy.int64)
+        self.positions = numpy.zeros(len(self.lengths), dtype=numpy.int64)
+        self.filled = numpy.zeros(len(self.lengths), dtype=bool)
+
+    def reset(self):
+        """
+        Forget the pages held e.g. when a different edf is opened, the next move() reads every page in full
+        """
+        self.filled[:] = False
+
+    def move(self, i, position, read):
+        """
+        Bring the page of channel i to start at a sample position, reading only the samples that are not already held
+        :param i: The channel index
+        :param position: The sample the page should start at
+        :param read: A function read(start, out) that fills the array out with the samples from start onwards
+        """
+        length = int(self.lengths[i])
+        if length == 0:
+            return
+        old = int(self.positions[i])
+        shift = position - old
+        if self.filled[i] and shift == 0:
+            return
+        if self.filled[i] and abs(shift) < length:
+            # The new samples go into the slots of the samples that scrolled out of view
+            self.heads[i] = (self.heads[i] + shift) % length
+            start = old + length if shift > 0 else position
+            count = abs(shift)
+        else:
+            self.heads[i] = 0
+            start = position
+            count = length
+        self.positions[i] = position
+        self.filled[i] = True
+
+        values = numpy.empty(count, dtype=numpy.float64)
+        read(start, values)
+        slot = (int(self.heads[i]) + start - position) % length
+        first = min(count, length - slot)
+        region = self.data[self.offsets[i]:self.offsets[i] + 2 * length]
+        for begin, chunk in ((slot, values[:first]), (0, values[first:])):
+            region[begin:begin + chunk.size] = chunk
+            region[length + begin:length + begin + chunk.size] = chunk
+
+    def view(self, i):
+        """
+        :param i: The channel index
+        :return: A contiguous numpy view of the current page for channel i
+        """
+        start = self.offsets[i] + self.heads[i]
+        return self.data[start:start + self.lengths[i]]
+
+    def pages(self):
+        """
+        :return: The current page of every channel back to back in one array, channel i starting at
+                 page_offsets()[i], for projecting them all at once
+        """
+        if len(self.lengths) == 0:
+            return numpy.empty(0, dtype=numpy.float64)
+        return numpy.concatenate([self.view(i) for i in range(len(self.lengths))])
+
+    def page_offsets(self):
+        """
+        :return: Where each channel starts in the array from pages()
+        """
+        offsets = numpy.zeros(len(self.lengths), dtype=numpy.int64)
+        if len(self.lengths) > 1:
+            offsets[1:] = numpy.cumsum(self.lengths[:-1])
+        return offsets
@@ -0,0 +1,59 @@
+import cv2
+
+
+class Compositor:
+
+    def __init__(self, margin=2):
+        """
+        Draws short lived overlays, like the gaze circles for a single sample, over a frame that changes much less often
+        without copying the whole frame for every overlay. The output frame is copied from the base once, then before
+        each overlay only the rectangles the last overlay drew over are restored from the base.
+        :param margin: Extra pixels around each marked rectangle, for anti-aliasing
+        """
+        self.margin = margin
+        self.base = None
+        self.frame = None
+        self.dirty = []
+
+    def set_base(self, image):
+        """
+        Start drawing over a new base frame e.g. when the screenshot changes
+        :param image: The frame the overlays are drawn over, it is not modified
+        """
+        self.base = image
+        if self.frame is None or self.frame.shape != image.shape or self.frame.dtype != image.dtype:
+            self.frame = image.copy()
+        else:
+            self.frame[...] = image
+        self.dirty = []
+
+    def begin(self):
+        """
+        Clear the last overlay from the output frame
+        :return: The output frame, clean and ready for the next overlay to be drawn on it
+        """
+        for x0, y0, x1, y1 in self.dirty:
+            self.frame[y0:y1, x0:x1] = self.base[y0:y1, x0:x1]
+        self.dirty = []
+        return self.frame
+
+    def mark(self, x0, y0, x1, y1):
+        """
+        Record that the overlay drew inside a rectangle, so it is cleared before the next one
+        """
+        height, width = self.frame.shape[:2]
+        x0 = min(max(int(x0) - self.margin, 0), width)
+        y0 = min(max(int(y0) - self.margin, 0), height)
+        x1 = min(max(int(x1) + self.margin + 1, 0), width)
+        y1 = min(max(int(y1) + self.margin + 1, 0), height)
+        if x1 > x0 and y1 > y0:
+            self.dirty.append((x0, y0, x1, y1))
+
+    def mark_circle(self, center, radius, thickness):
+        reach = radius + thickness
+        self.mark(center[0] - reach, center[1] - reach, center[0] + reach, center[1] + reach)
+
+    def mark_text(self, text, origin, font_type, font_scale, font_thick):
+        (width, height), baseline = cv2.getTextSize(text, font_type, font_scale, font_thick)
+        self.mark(origin[0] - font_thick, origin[1] - height - font_thick, origin[0] + width + font_thick,
+                  origin[1] + baseline + font_thick)
@@ -1,7 +1,7 @@
-from datetime import datetime
+import ast
 
 import cv2
-import ast
+from timestamps import TimestampParser, GAZE_TIMESTAMP
 
 
 class EyeState:
@@ -19,20 +19,16 @@ class EyeState:
         self.gaze = None
         self.image_width = None
         self.image_height = None
+        self.timestamp_parser = TimestampParser(GAZE_TIMESTAMP)
 
     def update(self, data):
         """
         Read an entry from the EYE log file and reconstruct the gaze using the information
         :param data: A line from the EYE log loaded into a dictionary
         """
-        # Convert the timestamp from string. Handle format if the stamp includes sub-second time
-        timestamp = data["timestamp"]
-        try:
-            self.time_stamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
-        except ValueError:
-            pass
+        # Convert the timestamp from string. The parser handles stamps with and without sub-second time
         try:
-            self.time_stamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+            self.time_stamp = self.timestamp_parser.parse(data["timestamp"])
         except ValueError:
             pass
 
@@ -50,19 +46,27 @@ class EyeState:
         else:
             self.center_gaze = None
 
-    def draw(self, image):
+    def circles(self):
         """
-        Draw some circles describing the location of the eye tracking and current gaze
-        :param image: The corresponding screenshot for the point in time of the current state
-        :return: An image with some new circles
+        :return: The circles describing the eyes and gaze as (center, radius, color, thickness), for what was recorded
         """
+        circles = []
         if self.left_eye is not None:
-            image = cv2.circle(image, self.left_eye, 5, (0, 0, 200), thickness=2)
+            circles.append((self.left_eye, 5, (0, 0, 200), 2))
         if self.right_eye is not None:
-            image = cv2.circle(image, self.right_eye, 5, (0, 0, 200), thickness=2)
+            circles.append((self.right_eye, 5, (0, 0, 200), 2))
         if self.center_gaze is not None:
-            image = cv2.circle(image, self.center_gaze, 30, (255, 51, 221), thickness=3)
-        return image
+            circles.append((self.center_gaze, 30, (255, 51, 221), 3))
+        return circles
+
+    def draw(self, image, compositor=None):
+        """
+        Draw some circles describing the location of the eye tracking and current gaze
+        :param image: The corresponding screenshot for the point in time of the current state
+        :param compositor: Optionally a Compositor to mark where the circles were drawn
+        :return: An image with some new circles
+        """
+        return draw_circles(image, self.circles(), compositor)
 
     def format_coords(self, coords):
         """
@@ -82,3 +86,19 @@ class EyeState:
         :return: A pixel coordinate tuple e.g. (234, 765) - describing the current gaze spot
         """
         return (int(((left_eye[0] + right_eye[0]) / 2)), int(((left_eye[1] + right_eye[1]) / 2)))
+
+
+def draw_circles(image, circles, compositor=None, thickness=None):
+    """
+    :param image: The image to draw on
+    :param circles: A list of (center, radius, color, thickness) as given by EyeState.circles
+    :param compositor: Optionally a Compositor to mark where the circles were drawn
+    :param thickness: Draw every circle this thick instead of its own thickness e.g. for a faint trail
+    :return: The image with the circles drawn on it
+    """
+    for center, radius, color, circle_thickness in circles:
+        circle_thickness = circle_thickness if thickness is None else thickness
+        image = cv2.circle(image, center, radius, color, thickness=circle_thickness)
+        if compositor is not None:
+            compositor.mark_circle(center, radius, circle_thickness)
+    return image
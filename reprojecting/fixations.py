@@ -0,0 +1,299 @@
+import csv
+import datetime
+import json
+import os
+import struct
+
+import numpy
+
+from uistate import UIState
+from montage import MontageCache
+from timestamps import TimestampParser, GAZE_TIMESTAMP, UI_TIMESTAMP, to_microseconds
+
+# While one of these was the last event the graph is covered, so nothing on it can be looked at
+HIDDEN_EVENTS = ("MENU_OPENED", "MENU_SEARCH", "MODAL_OPENED", "WINDOW_MINIMISED")
+# How far in pixels a baseline can be from the gaze point for its channel to count as fixated
+FIXATION_RANGE = 30
+COORDINATE_SEPARATORS = str.maketrans('(),', '   ')
+
+
+class FixationAnalysis:
+
+    def __init__(self, directory, image_width, image_height, montage_cache=None, path_map=None, interactive=True):
+        """
+        Works out which channels were looked at and the EEG time under the gaze for every gaze sample of a session at
+        once, rather than stepping the UI and eye logs along together one sample at a time as PlayBack does. The gaze log
+        is loaded into arrays, the UI log is replayed once into a table with a row for each UI state, and each gaze
+        sample is joined to the UI state PlayBack would have had when it reached that sample. The results match
+        PlayBack.analyse_fixation_baselines sample for sample.
+
+        Sample i of the results is gaze log line i + 1, the first line is only used to skip the UI log to the start of
+        the eye tracking, as in PlayBack.process.
+        :param directory: The session directory, containing gaze_data.txt and uilog
+        :param image_width: The width of the screenshots, to scale the normalised gaze coordinates
+        :param image_height: The height of the screenshots
+        :param montage_cache: A MontageCache to share parsed montages, a private one is used if None
+        :param path_map: A list of (old root, new root) pairs for edf paths recorded on another machine
+        :param interactive: Ask for an edf that can not be found, if False a FileNotFoundError is raised instead
+        """
+        self.ui_log_path = os.path.join(directory, 'uilog', 'ui_log.txt')
+        self.eye_log_path = os.path.join(directory, 'gaze_data.txt')
+        self.montages_directory = os.path.join(directory, 'uilog', 'montages')
+        self.image_width = image_width
+        self.image_height = image_height
+        self.montage_cache = montage_cache if montage_cache is not None else MontageCache()
+        self.path_map = path_map
+        self.interactive = interactive
+
+        self.load_gaze()
+        self.load_ui_timeline()
+        self.join()
+        self.analyse()
+
+    def load_gaze(self):
+        """
+        Read the whole gaze log into arrays. Timestamps that can not be read take the one before, and a sample with
+        either eye missing has no gaze point, the same as EyeState.
+        """
+        with open(self.eye_log_path, 'r') as log:
+            lines = [line for line in log.read().splitlines() if line.strip()]
+        entries = json.loads(f"[{','.join(lines)}]")
+
+        self.gaze_timestamps = gaze_timestamps([e["timestamp"] for e in entries])
+
+        self.left_eye, left_valid = self.format_coords([e["left_eye"] for e in entries])
+        self.right_eye, right_valid = self.format_coords([e["right_eye"] for e in entries])
+        self.has_gaze = left_valid & right_valid
+        self.center_gaze = ((self.left_eye + self.right_eye) / 2).astype(numpy.int64)
+
+    def format_coords(self, coords):
+        """
+        Scale a column of normalised coordinates to pixels, as EyeState.format_coords does for one
+        :param coords: A list of coordinate strings from the log e.g. "(0.3, 0.12344)"
+        :return: An (n, 2) int64 array of pixel coordinates, and a mask of which were recorded i.e. not nan
+        """
+        # Turn the brackets and commas into spaces and read every number in one go, nan for the missing eyes
+        numbers = ' '.join(coords).translate(COORDINATE_SEPARATORS).split()
+        normalised = numpy.array(numbers, dtype=numpy.float64).reshape(len(coords), 2)
+        valid = ~numpy.isnan(normalised).any(axis=1)
+        pixels = numpy.zeros((len(coords), 2), dtype=numpy.int64)
+        pixels[valid] = (normalised[valid] * (self.image_width, self.image_height)).astype(numpy.int64)
+        return pixels, valid
+
+    def load_ui_timeline(self):
+        """
+        Replay the UI log once and keep what the analysis needs from the state after each event. Row k of the table is
+        the state once the first k events have been applied.
+        """
+        ui = UIState(self.montages_directory, montage_cache=self.montage_cache, path_map=self.path_map,
+                     interactive=self.interactive)
+        parser = TimestampParser(UI_TIMESTAMP)
+        timestamps = []
+        rows = [self.timeline_row(ui)]
+        with open(self.ui_log_path, 'r') as log:
+            for line in log:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                timestamps.append(parser.parse(entry['timestamp']))
+                ui.update(entry)
+                rows.append(self.timeline_row(ui))
+
+        self.ui_timestamps = to_microseconds(numpy.array(timestamps, dtype='datetime64[us]'))
+        self.log_ids = [row[0] for row in rows]
+        self.last_events = numpy.array([row[1] for row in rows], dtype=object)
+        self.visible = numpy.array([row[2] for row in rows], dtype=bool)
+        self.graph_left = numpy.array([row[3] for row in rows], dtype=numpy.int64)
+        self.graph_right = numpy.array([row[4] for row in rows], dtype=numpy.int64)
+        self.seconds_per_pixel = numpy.array([row[5] for row in rows], dtype=numpy.float64)
+        self.time_positions = numpy.array([row[6] for row in rows], dtype=numpy.float64)
+        self.channel_labels = [row[7] for row in rows]
+
+        # Baselines padded with nan to the most channels any state had, so every state fits in one table
+        max_channels = max(len(row[8]) for row in rows)
+        self.baselines = numpy.full((len(rows), max_channels), numpy.nan)
+        for k, row in enumerate(rows):
+            self.baselines[k, :len(row[8])] = row[8]
+
+    @staticmethod
+    def timeline_row(ui):
+        if ui.graph_top_left is None or ui.graph_width is None:
+            return ui.log_id, ui.last_event, False, 0, 0, numpy.nan, numpy.nan, [], numpy.empty(0)
+        seconds_per_pixel = numpy.nan
+        if ui.timescale_to_seconds() is not None:
+            seconds_per_pixel = ui.timescale_to_seconds() / ui.graph_width
+        time_position = ui.time_position_to_seconds()
+        baselines = ui.get_baselines()
+        return (ui.log_id, ui.last_event, True, ui.graph_top_left[0], ui.graph_top_right[0], seconds_per_pixel,
+                numpy.nan if time_position is None else time_position,
+                [channel.label.strip() for channel in ui.channels], baselines.astype(numpy.float64))
+
+    def join(self):
+        """
+        Find the UI state for every gaze sample. PlayBack applies at most one UI event per gaze sample, once the gaze
+        time is past the next event, and never applies the last event. With a[s] the number of events before sample s
+        capped at the second to last, the number applied is c[s] = c[s - 1] + (a[s] > c[s - 1]) starting from a[0]. When
+        a never decreases this is c[s] = min(a[r] + s - r) over r <= s, a running minimum.
+        """
+        applied = applied_events(self.ui_timestamps, self.gaze_timestamps)
+
+        # The first sample only sets where playback starts
+        self.ui_index = applied[1:]
+        self.timestamps = self.gaze_timestamps[1:]
+        self.gaze = self.center_gaze[1:]
+        self.gaze_valid = self.has_gaze[1:]
+
+    def analyse(self):
+        """
+        The fixated channels and gaze time for every sample at once, see PlayBack.analyse_fixation_baselines
+        """
+        state = self.ui_index
+        hidden = numpy.isin(self.last_events, HIDDEN_EVENTS)
+        looking = self.gaze_valid & ~hidden[state] & self.visible[state]
+        gaze_x = self.gaze[:, 0]
+        gaze_y = self.gaze[:, 1]
+        self.on_graph = looking & (self.graph_left[state] < gaze_x) & (gaze_x < self.graph_right[state])
+
+        self.gaze_seconds = numpy.full(len(state), numpy.nan)
+        on = self.on_graph
+        self.gaze_seconds[on] = (self.time_positions[state[on]] +
+                                 self.seconds_per_pixel[state[on]] * (gaze_x[on] - self.graph_left[state[on]]))
+
+        self.fixated = numpy.zeros((len(state), self.baselines.shape[1]), dtype=bool)
+        baselines = self.baselines[state[on]]
+        y = gaze_y[on, None]
+        self.fixated[on] = (baselines < y + FIXATION_RANGE) & (baselines > y - FIXATION_RANGE)
+
+    def gaze_targets(self, i):
+        """
+        :param i: The sample index
+        :return: The labels of the fixated channels, or ["Off"] if the gaze was not on the graph, as in PlayBack
+        """
+        if not self.on_graph[i]:
+            return ["Off"]
+        labels = self.channel_labels[self.ui_index[i]]
+        return [labels[j] for j in numpy.flatnonzero(self.fixated[i])]
+
+    def gaze_time(self, i):
+        """
+        :param i: The sample index
+        :return: The time into the recording under the gaze as a timedelta, or "Off", as in PlayBack. A position that
+                 does not project to a time e.g. while no edf is open is also "Off"
+        """
+        if not self.on_graph[i] or not numpy.isfinite(self.gaze_seconds[i]):
+            return "Off"
+        return datetime.timedelta(seconds=float(self.gaze_seconds[i]))
+
+    def columns(self):
+        """
+        :return: The per sample results as a dictionary of equal length columns, for export
+        """
+        none = ~self.gaze_valid
+        # The gaze stays on the same channels for runs of samples, so join the labels once for each run
+        state = numpy.where(self.on_graph, self.ui_index, -1)
+        changed = numpy.ones(len(state), dtype=bool)
+        changed[1:] = (state[1:] != state[:-1]) | numpy.any(self.fixated[1:] != self.fixated[:-1], axis=1)
+        starts = numpy.flatnonzero(changed)
+        runs = numpy.array([", ".join(self.gaze_targets(i)) for i in starts.tolist()], dtype=object)
+        labels = numpy.repeat(runs, numpy.diff(numpy.append(starts, len(state))))
+        return {
+            'timestamp': self.timestamps.astype('datetime64[us]'),
+            'gaze_x': numpy.where(none, -1, self.gaze[:, 0]),
+            'gaze_y': numpy.where(none, -1, self.gaze[:, 1]),
+            'on_graph': self.on_graph,
+            'channels': labels,
+            'eeg_time': self.gaze_seconds,
+            'ui_log_id': numpy.array([-1 if log_id is None else int(log_id) for log_id in self.log_ids])[self.ui_index],
+            'ui_event': self.last_events.astype(str)[self.ui_index],
+        }
+
+    def save(self, path):
+        """
+        Write the results with a row per gaze sample, as compressed numpy arrays if the path ends in .npz otherwise as
+        CSV. eeg_time is the seconds into the recording under the gaze, nan or empty when the gaze was off the graph.
+        :param path: The file to write
+        """
+        columns = self.columns()
+        if path.endswith('.npz'):
+            columns['channels'] = columns['channels'].astype(str)
+            numpy.savez_compressed(path, **columns)
+            return
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(columns))
+            eeg_time = ['' if numpy.isnan(t) else repr(t) for t in columns['eeg_time'].tolist()]
+            writer.writerows(zip(numpy.datetime_as_string(columns['timestamp']).tolist(), columns['gaze_x'].tolist(),
+                                 columns['gaze_y'].tolist(), columns['on_graph'].astype(int).tolist(),
+                                 columns['channels'].tolist(), eeg_time, columns['ui_log_id'].tolist(),
+                                 columns['ui_event'].tolist()))
+
+
+def gaze_timestamps(stamps):
+    """
+    :param stamps: The timestamp strings of the gaze log
+    :return: The timestamps in microseconds, one that can not be read takes the one before as EyeState keeps its last
+    """
+    stamps = to_microseconds(TimestampParser(GAZE_TIMESTAMP).parse_column(stamps))
+    readable = stamps != numpy.datetime64('NaT', 'us').astype(numpy.int64)
+    previous = numpy.maximum.accumulate(numpy.where(readable, numpy.arange(len(stamps)), 0))
+    return stamps[previous]
+
+
+def applied_events(ui_timestamps, gaze_timestamps):
+    """
+    The number of UI events PlayBack has applied when it reaches each gaze sample, see FixationAnalysis.join
+    :param ui_timestamps: The UI event timestamps in microseconds
+    :param gaze_timestamps: The gaze sample timestamps in microseconds
+    :return: An int64 array with the number of events applied at each gaze sample
+    """
+    num_events = len(ui_timestamps)
+    cap = max(num_events - 1, 0)
+    ahead = numpy.minimum(numpy.searchsorted(ui_timestamps, gaze_timestamps, side='left'), cap)
+    steps = numpy.arange(len(ahead))
+    if numpy.all(numpy.diff(ui_timestamps) >= 0) and numpy.all(numpy.diff(ahead) >= 0):
+        return numpy.minimum.accumulate(ahead - steps) + steps
+    # Out of order timestamps, follow PlayBack step by step
+    applied = numpy.empty(len(ahead), dtype=numpy.int64)
+    count = 0
+    while count < cap and len(ahead) and gaze_timestamps[0] > ui_timestamps[count]:
+        count += 1
+    for s, stamp in enumerate(gaze_timestamps.tolist()):
+        if s > 0 and count < cap and stamp > ui_timestamps[count]:
+            count += 1
+        applied[s] = count
+    return applied
+
+
+def png_size(path):
+    """
+    Read the size of a PNG from its header, without decoding the image
+    :param path: The path to the PNG
+    :return: (width, height)
+    """
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    assert header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR', f"{path} is not a PNG"
+    return struct.unpack('>II', header[16:24])
+
+
+def analyse_session(directory, output_path=None, persist_montages=False, path_map=None, headless=False):
+    """
+    Produce the fixation results for a session without rendering anything
+    :param directory: The session directory
+    :param output_path: Where to write the results, fixations.npz in the session directory if None
+    :param persist_montages: Keep the parsed montages in the session directory for later runs
+    :param path_map: A list of (old root, new root) pairs for edf paths recorded on another machine
+    :param headless: Never ask for input. The analysis follows the view alone, so it does not need the edf files
+    :return: The FixationAnalysis
+    """
+    assert (os.path.exists(directory)), f"The specified input directory is invalid {directory}"
+    cache_path = os.path.join(directory, 'uilog', 'montages.cache') if persist_montages else None
+    montage_cache = MontageCache(cache_path)
+    image_width, image_height = png_size(os.path.join(directory, 'uilog', 'screenshots', '0.png'))
+    analysis = FixationAnalysis(directory, image_width, image_height, montage_cache, path_map, not headless)
+    montage_cache.save()
+    if output_path is None:
+        output_path = os.path.join(directory, 'fixations.npz')
+    analysis.save(output_path)
+    print(f"Wrote {len(analysis.timestamps)} samples to {output_path}")
+    return analysis
@@ -0,0 +1,165 @@
+import json
+import os
+import pickle
+
+import numpy
+
+from uistate import UIState
+from timestamps import TimestampParser, UI_TIMESTAMP
+
+# Bump when the snapshot layout changes so stale sidecars are rebuilt
+KEYFRAMES_VERSION = 1
+
+
+class KeyframeIndex:
+
+    def __init__(self, ui_log_path, interval=200):
+        """
+        Snapshots of the UI state taken every interval events through a UI log, along with where in the log each one
+        was taken. Seeking restores the nearest snapshot before the target and replays only the events after it, rather
+        than replaying the whole log from the first line.
+        :param ui_log_path: The path to ui_log.txt
+        :param interval: The number of events between snapshots
+        """
+        self.ui_log_path = ui_log_path
+        self.interval = interval
+        self.log_ids = []
+        self.timestamps = numpy.empty(0, dtype=numpy.int64)
+        self.offsets = numpy.empty(0, dtype=numpy.int64)
+        self.snapshots = []
+
+    @staticmethod
+    def sidecar_path(ui_log_path):
+        return f"{os.path.splitext(ui_log_path)[0]}.keyframes"
+
+    @classmethod
+    def for_session(cls, ui_log_path, montages_directory, interval=200, path_map=None):
+        """
+        Load the keyframes kept next to the log, building and saving them first if they are missing or out of date
+        :param ui_log_path: The path to ui_log.txt
+        :param montages_directory: The montages saved with the log
+        :param interval: The number of events between snapshots when building
+        :param path_map: A list of (old root, new root) pairs for edf paths recorded on another machine
+        :return: A KeyframeIndex
+        """
+        index = cls.load(ui_log_path)
+        if index is None or index.interval != interval:
+            index = cls(ui_log_path, interval)
+            index.build(montages_directory, path_map)
+            index.save()
+        return index
+
+    def build(self, montages_directory, path_map=None):
+        """
+        Replay the log once and take a snapshot every interval events. Only the recorded state is kept, so no montages
+        are parsed and the edf files are never opened while building, even if they are missing.
+        :param montages_directory: The montages saved with the log
+        :param path_map: A list of (old root, new root) pairs for edf paths recorded on another machine
+        """
+        ui = UIState(montages_directory, signals=False, path_map=path_map, interactive=False)
+        log_ids = []
+        timestamps = []
+        offsets = []
+        self.snapshots = []
+        count = 0
+        with open(self.ui_log_path, 'rb') as log:
+            while True:
+                line = log.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                ui.update(json.loads(line))
+                count += 1
+                if count % self.interval == 0:
+                    log_ids.append(ui.log_id)
+                    timestamps.append(numpy.datetime64(ui.current_timestamp, 'us').astype(numpy.int64))
+                    offsets.append(log.tell())
+                    self.snapshots.append(ui.snapshot())
+        self.log_ids = log_ids
+        self.timestamps = numpy.array(timestamps, dtype=numpy.int64)
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)
+
+    def seek(self, ui, log_id=None, timestamp=None):
+        """
+        Bring a UI state to where it was just after an event in the log. Give either the log id of the event, or a
+        time to get the state at that time i.e. after the last event at or before it.
+        :param ui: The UIState to restore into, it keeps its own signals setting and montage cache
+        :param log_id: The id of the event to seek to
+        :param timestamp: A datetime to seek to
+        :return: The byte offset of the next line in the log, to carry on reading from
+        """
+        assert (log_id is None) != (timestamp is None), "Seek to either a log id or a timestamp"
+        if log_id is not None:
+            candidates = [i for i, keyframe_id in enumerate(self.log_ids) if int(keyframe_id) <= int(log_id)]
+            keyframe = candidates[-1] if candidates else -1
+        else:
+            target = numpy.datetime64(timestamp, 'us').astype(numpy.int64)
+            keyframe = int(numpy.searchsorted(self.timestamps, target, side='right')) - 1
+
+        if keyframe >= 0:
+            ui.restore(self.snapshots[keyframe])
+            offset = int(self.offsets[keyframe])
+            if log_id is not None and int(ui.log_id) == int(log_id):
+                return offset
+        else:
+            ui.restore(UIState(ui.montages_directory, path_map=ui.path_map, interactive=False).snapshot())
+            offset = 0
+
+        # Replay the events between the keyframe and the target
+        parser = TimestampParser(UI_TIMESTAMP)
+        with open(self.ui_log_path, 'rb') as log:
+            log.seek(offset)
+            while True:
+                line = log.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    offset = log.tell()
+                    continue
+                entry = json.loads(line)
+                if timestamp is not None and parser.parse(entry['timestamp']) > timestamp:
+                    break
+                ui.update(entry)
+                offset = log.tell()
+                if log_id is not None and int(entry['id']) == int(log_id):
+                    break
+        return offset
+
+    @classmethod
+    def load(cls, ui_log_path):
+        """
+        :param ui_log_path: The path to ui_log.txt
+        :return: The saved KeyframeIndex, or None if there is none or the log has changed since it was built
+        """
+        path = cls.sidecar_path(ui_log_path)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                saved = pickle.load(f)
+        except Exception:
+            print(f"Could not read the keyframes at {path}, rebuilding them")
+            return None
+        stat = os.stat(ui_log_path)
+        if saved.get('version') != KEYFRAMES_VERSION or saved['log'] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        index = cls(ui_log_path, saved['interval'])
+        index.log_ids = saved['log_ids']
+        index.timestamps = saved['timestamps']
+        index.offsets = saved['offsets']
+        index.snapshots = saved['snapshots']
+        return index
+
+    def save(self):
+        """
+        Write the keyframes next to the log, tagged with the size and modification time of the log they came from
+        """
+        path = self.sidecar_path(self.ui_log_path)
+        stat = os.stat(self.ui_log_path)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': KEYFRAMES_VERSION, 'log': (stat.st_size, stat.st_mtime_ns),
+                         'interval': self.interval, 'log_ids': self.log_ids, 'timestamps': self.timestamps,
+                         'offsets': self.offsets, 'snapshots': self.snapshots}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
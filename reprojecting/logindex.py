@@ -0,0 +1,195 @@
+import os
+import re
+
+import numpy
+
+from timestamps import TimestampParser, to_microseconds
+
+# Bump when the sidecar layout, or how the log is read into it, changes so stale indexes are rebuilt
+INDEX_VERSION = 2
+
+# The timestamp field of a log entry, with or without spaces around the colon however the line was written
+TIMESTAMP_PATTERN = re.compile(rb'"timestamp"\s*:\s*"([^"]*)"')
+
+
+class LogIndex:
+
+    def __init__(self, log_path, timestamp_format, stride=1):
+        """
+        The timestamp and byte offset of the entries of a newline delimited JSON log, so a time can be found with a
+        searchsorted and a single seek instead of reading the log from the start.
+        :param log_path: The path to the log e.g. ui_log.txt or gaze_data.txt
+        :param timestamp_format: The TimestampFormat of the log e.g. UI_TIMESTAMP or GAZE_TIMESTAMP
+        :param stride: Index every stride-th entry, the entries in between are read through when seeking
+        """
+        self.log_path = log_path
+        self.timestamp_format = timestamp_format
+        self.stride = stride
+        self.num_entries = 0
+        self.entries = numpy.empty(0, dtype=numpy.int64)
+        self.timestamps = numpy.empty(0, dtype=numpy.int64)
+        self.offsets = numpy.empty(0, dtype=numpy.int64)
+
+    @staticmethod
+    def sidecar_path(log_path):
+        return f"{os.path.splitext(log_path)[0]}.index.npz"
+
+    @classmethod
+    def for_log(cls, log_path, timestamp_format, stride=1):
+        """
+        Load the index kept next to the log, building and saving it first if it is missing or out of date
+        :param log_path: The path to the log
+        :param timestamp_format: The TimestampFormat of the log
+        :param stride: Index every stride-th entry
+        :return: A LogIndex
+        """
+        index = cls(log_path, timestamp_format, stride)
+        if not index.load():
+            index.build()
+            index.save()
+        return index
+
+    def build(self):
+        """
+        Read the log once, pulling the timestamp straight out of each line rather than decoding the whole JSON entry,
+        then parse them all at once. A timestamp that can not be read takes the one before it, the same as EyeState.
+        """
+        offsets = []
+        stamps = []
+        offset = 0
+        with open(self.log_path, 'rb') as log:
+            for line in log:
+                stamp = extract_timestamp(line)
+                if stamp is not None:
+                    offsets.append(offset)
+                    stamps.append(stamp)
+                offset += len(line)
+
+        self.num_entries = len(offsets)
+        self.entries = numpy.arange(0, self.num_entries, self.stride, dtype=numpy.int64)
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)[self.entries]
+        parsed = to_microseconds(TimestampParser(self.timestamp_format).parse_column(stamps))
+        # NaT is the smallest int64 so a running maximum carries the previous timestamp forward, and keeps it sorted
+        self.timestamps = numpy.maximum.accumulate(parsed)[self.entries] if self.num_entries else parsed
+
+    def find(self, timestamp):
+        """
+        :param timestamp: A datetime
+        :return: (entry number, byte offset) of the last indexed entry before the timestamp, or of the first entry
+        """
+        target = numpy.datetime64(timestamp, 'us').astype(numpy.int64)
+        i = max(int(numpy.searchsorted(self.timestamps, target, side='left')) - 1, 0)
+        if len(self.offsets) == 0:
+            return 0, 0
+        return int(self.entries[i]), int(self.offsets[i])
+
+    def seek(self, log, timestamp):
+        """
+        Move a log opened by the caller to the first entry at or after a time. Reading then carries on from there.
+        :param log: The open log file, in text or binary mode
+        :param timestamp: A datetime
+        :return: The number of the entry the log is now at
+        """
+        entry, offset = self.find(timestamp)
+        log.seek(offset)
+        parser = TimestampParser(self.timestamp_format)
+        while True:
+            position = log.tell()
+            line = log.readline()
+            if not line:
+                return entry
+            stamp = extract_timestamp(line)
+            if stamp is None:
+                continue
+            try:
+                if parser.parse(stamp) >= timestamp:
+                    log.seek(position)
+                    return entry
+            except ValueError:
+                pass
+            entry += 1
+
+    def load(self):
+        """
+        :return: True if a saved index for the log was read, False if there is none or the log has changed
+        """
+        path = self.sidecar_path(self.log_path)
+        if not os.path.exists(path):
+            return False
+        stat = os.stat(self.log_path)
+        try:
+            with numpy.load(path) as saved:
+                if saved['header'].tolist() != [INDEX_VERSION, stat.st_size, stat.st_mtime_ns, self.stride]:
+                    return False
+                self.num_entries = int(saved['num_entries'])
+                self.entries = saved['entries']
+                self.timestamps = saved['timestamps']
+                self.offsets = saved['offsets']
+        except Exception:
+            print(f"Could not read the log index at {path}, rebuilding it")
+            return False
+        return True
+
+    def save(self):
+        """
+        Write the index next to the log, tagged with the size and modification time of the log it came from. Keeping it
+        is only to save building it again, so where it can not be written e.g. on a read only mirror the index is just
+        kept in memory.
+        """
+        path = self.sidecar_path(self.log_path)
+        stat = os.stat(self.log_path)
+        tmp_path = f"{path}.tmp.npz"
+        try:
+            numpy.savez(tmp_path, header=numpy.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns, self.stride],
+                                                     dtype=numpy.int64),
+                        num_entries=self.num_entries, entries=self.entries, timestamps=self.timestamps,
+                        offsets=self.offsets)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not save the log index at {path}, it will be built again next time: {e}")
+            if os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+
+class LogCursor:
+
+    def __init__(self, log, timestamp_format):
+        """
+        Steps through a log keeping the line in front, of which only the timestamp is decoded. Lets the time of the
+        next entry be checked without decoding it or applying it to a state.
+        :param log: The open log file
+        :param timestamp_format: The TimestampFormat of the log
+        """
+        self.log = log
+        self.parser = TimestampParser(timestamp_format)
+        self.line = None
+        self.next_line = None
+        self.next_timestamp = None
+
+    def advance(self):
+        """
+        Move on one line, the line in front becomes the current line
+        :return: False if there is no line in front i.e. the end of the log
+        """
+        self.line = self.next_line
+        self.next_line = self.log.readline()
+        if self.next_line == "":
+            return False
+        self.next_timestamp = self.parser.parse(extract_timestamp(self.next_line))
+        return True
+
+
+def extract_timestamp(line):
+    """
+    :param line: A line of the log
+    :return: The timestamp string of the entry, or None if the line has no timestamp e.g. a blank line
+    """
+    if isinstance(line, str):
+        line = line.encode()
+    match = TIMESTAMP_PATTERN.search(line)
+    if match is None:
+        return None
+    return match.group(1).decode()
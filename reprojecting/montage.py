@@ -0,0 +1,148 @@
+import hashlib
+import os
+import pickle
+
+import numpy
+from channel import Channel
+from filter_class import FidFilter
+
+
+# Bump when the parsed representation changes so stale persisted caches are discarded
+CACHE_VERSION = 3
+
+FILTER_DTYPE = numpy.dtype([('channel', numpy.int32), ('type', numpy.int32), ('frequency', numpy.float64),
+                            ('frequency2', numpy.float64), ('ripple', numpy.float64), ('order', numpy.int32),
+                            ('model', numpy.int32)])
+
+# The montage elements we read and which column of the channel and filter tables they fill
+SIGNAL_FIELDS = {'label': 0, 'factor': 1}
+CHANNEL_FIELDS = {'voltpercm': 2, 'screen_offset': 3, 'polarity': 4, 'filter_cnt': 5}
+FILTER_FIELDS = {'type': 1, 'frequency': 2, 'frequency2': 3, 'ripple': 4, 'order': 5, 'model': 6}
+
+
+def channel_dtype(label_length):
+    """
+    :param label_length: The length of the longest label in the montage, the label field is sized to fit it
+    :return: The dtype of a row of the channel table
+    """
+    return numpy.dtype([('label', f'U{max(1, label_length)}'), ('factor', numpy.float64),
+                        ('voltpercm', numpy.float64), ('screen_offset', numpy.float64), ('polarity', numpy.int32),
+                        ('filter_cnt', numpy.int32)])
+
+
+class Montage:
+
+    def __init__(self, channels, filters):
+        """
+        The parsed contents of a .mtg file. Holds only what was read from the file so a single parse can be shared
+        between UI states, each state builds its own channels from it.
+        :param channels: A structured array with a channel_dtype() row for each signal composition
+        :param filters: A structured array with a FILTER_DTYPE row for each filter, referencing its channel by index
+        """
+        self.channels = channels
+        self.filters = filters
+
+    def build_channels(self):
+        """
+        Create a fresh set of channels from the montage
+        :return: A list of Channel objects with their filters attached
+        """
+        channels = [Channel(i, *row) for i, row in enumerate(self.channels.tolist())]
+        for row in self.filters.tolist():
+            channels[row[0]].fid_filters.append(FidFilter(*row[1:]))
+        return channels
+
+
+class MontageCache:
+
+    def __init__(self, cache_path=None):
+        """
+        A new montage file is saved for every montage affecting event, but most of them are identical or nearly so.
+        Keep the parsed montages keyed by a hash of the file contents so that each distinct montage is only parsed once.
+        :param cache_path: Optionally a file to persist the parsed montages to, e.g. in the session directory
+        """
+        self.cache_path = cache_path
+        self.montages = {}
+        self.modified = False
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'rb') as f:
+                    cached = pickle.load(f)
+                if cached.get('version') == CACHE_VERSION:
+                    self.montages = cached['montages']
+            except Exception:
+                print(f"Could not read the montage cache at {self.cache_path}, starting a new one")
+                self.montages = {}
+
+    def load(self, montage_file_path):
+        """
+        Get the parsed montage for a .mtg file, parsing it only if the contents have not been seen before
+        :param montage_file_path: The path to the .mtg file
+        :return: A Montage
+        """
+        with open(montage_file_path, 'rb') as f:
+            content = f.read()
+        key = hashlib.sha1(content).hexdigest()
+        montage = self.montages.get(key)
+        if montage is None:
+            montage = parse_montage(content)
+            self.montages[key] = montage
+            self.modified = True
+        return montage
+
+    def save(self):
+        """
+        Write the parsed montages to the cache file, if one was given and anything new was parsed
+        """
+        if self.cache_path is None or not self.modified:
+            return
+        # Named for the process, as the parallel renderers of one session can save at the same time
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'montages': self.montages}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+        self.modified = False
+
+
+def parse_montage(content):
+    """
+    .mtg files can be parsed like XML. Walk the tree once and fill the channel and filter tables straight from the
+    elements, rather than evaluating an XPath expression for every field of every signal.
+    :param content: The raw bytes of a .mtg file
+    :return: A Montage
+    """
+    # Only needed on a cache miss, so a fully cached session never imports lxml
+    from lxml import etree
+    doc = etree.fromstring(content)
+    channels = []
+    filters = []
+    for composition in doc.iterchildren('signalcomposition'):
+        channel = [None] * 6
+        for element in composition:
+            tag = element.tag
+            if tag in CHANNEL_FIELDS:
+                channel[CHANNEL_FIELDS[tag]] = element.text
+            elif tag == 'signal':
+                # Only the first signal of a composition is used for the label and factor
+                if channel[0] is None:
+                    for field in element:
+                        if field.tag in SIGNAL_FIELDS:
+                            channel[SIGNAL_FIELDS[field.tag]] = field.text
+            elif tag == 'fidfilter':
+                fid_filter = [len(channels), None, None, None, None, None, None]
+                for field in element:
+                    if field.tag in FILTER_FIELDS:
+                        fid_filter[FILTER_FIELDS[field.tag]] = field.text
+                filters.append(fid_filter)
+        channels.append(channel)
+
+    label_length = max((len(str(channel[0])) for channel in channels), default=1)
+    channel_table = numpy.empty(len(channels), dtype=channel_dtype(label_length))
+    for i, (label, factor, voltpercm, screen_offset, polarity, filter_cnt) in enumerate(channels):
+        channel_table[i] = (label, float(factor), float(voltpercm), float(screen_offset), int(float(polarity)),
+                            int(float(filter_cnt)))
+    filter_table = numpy.empty(len(filters), dtype=FILTER_DTYPE)
+    for i, (index, ftype, frequency, frequency2, ripple, order, model) in enumerate(filters):
+        filter_table[i] = (index, int(float(ftype)), float(frequency), float(frequency2), float(ripple),
+                           int(float(order)), int(float(model)))
+    return Montage(channel_table, filter_table)
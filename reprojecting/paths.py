@@ -0,0 +1,82 @@
+import json
+import os
+
+
+def parse_path_map(mappings):
+    """
+    Read the path roots to remap from the command line
+    :param mappings: A list of OLD=NEW strings e.g. ["D:\\teetacsi_local=/mnt/teetacsi"]
+    :return: A list of (old root, new root) pairs
+    """
+    path_map = []
+    for mapping in mappings or []:
+        assert '=' in mapping, f"A path mapping should look like OLD=NEW, got {mapping}"
+        old, new = mapping.split('=', 1)
+        path_map.append((old, new))
+    return path_map
+
+
+def remap_path(path, path_map):
+    """
+    Swap the root of a path recorded on another machine for where it is found on this one. Roots are compared without
+    regard to case or the direction of the slashes, the longest matching root wins, and the rest of a Windows path has
+    its slashes turned around.
+    :param path: A path from a log e.g. D:\\teetacsi_local\\data\\00000768\\s003.edf
+    :param path_map: A list of (old root, new root) pairs from parse_path_map(), or None to leave the path as it is
+    :return: The remapped path, or the path unchanged if no root matches
+    """
+    normalised = path.replace('\\', '/').lower()
+    for old, new in sorted(path_map or [], key=lambda mapping: len(mapping[0]), reverse=True):
+        root = old.replace('\\', '/').rstrip('/').lower()
+        if normalised == root or normalised.startswith(root + '/'):
+            rest = path[len(root):].replace('\\', '/').lstrip('/')
+            return os.path.join(new, *rest.split('/')) if rest else new
+    return path
+
+
+def resolve_edf_path(path, path_map):
+    """
+    :param path: An edf path from a FILE_OPENED event
+    :param path_map: A list of (old root, new root) pairs, or None
+    :return: The path to open on this machine, or None if it can not be found
+    """
+    for candidate in (remap_path(path, path_map), path):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def session_edf_paths(ui_log_path):
+    """
+    :param ui_log_path: The path to ui_log.txt
+    :return: The edf paths of every FILE_OPENED event in the log, in order and without repeats
+    """
+    paths = []
+    with open(ui_log_path, 'r') as log:
+        for line in log:
+            if '"FILE_OPENED"' not in line:
+                continue
+            entry = json.loads(line)
+            if entry['event'] == 'FILE_OPENED' and entry['data']['edf_path'] not in paths:
+                paths.append(entry['data']['edf_path'])
+    return paths
+
+
+def resolve_session_edf_paths(ui_log_path, path_map):
+    """
+    Find every edf a session opens before it is processed, so a missing file stops the run straight away rather than
+    part way through
+    :param ui_log_path: The path to ui_log.txt
+    :param path_map: A list of (old root, new root) pairs, or None
+    :return: A dictionary from each path in the log to the path to open, raises FileNotFoundError if any are missing
+    """
+    resolved = {}
+    missing = []
+    for path in session_edf_paths(ui_log_path):
+        resolved[path] = resolve_edf_path(path, path_map)
+        if resolved[path] is None:
+            missing.append(path)
+    if missing:
+        raise FileNotFoundError(f"Could not find the edf files {missing} for {ui_log_path}, use --path-map to remap "
+                                f"their roots e.g. --path-map \"D:\\teetacsi_local=/mnt/teetacsi\"")
+    return resolved
@@ -4,39 +4,60 @@ import json
 import sys
 import time
 import traceback
-from copy import deepcopy
 import cv2
+import numpy
 
 from uistate import UIState
-from eyestate import EyeState
+from eyestate import EyeState, draw_circles
+from montage import MontageCache
+from compositor import Compositor
+from screenshots import ScreenshotCache
+from videowriter import CODECS, VideoWriterThread
+from keyframes import KeyframeIndex
+from logindex import LogCursor, LogIndex
+from paths import resolve_session_edf_paths
+from timestamps import GAZE_TIMESTAMP, UI_TIMESTAMP
 
 
 class PlayBack:
 
-    def __init__(self, directory=None, playback=False, video=False, signals=False, ui_mode=False):
+    def __init__(self, directory=None, playback=False, video=False, signals=False, ui_mode=False, persist_montages=False,
+                 path_map=None, headless=False, video_codec='mp4v', video_scale=1.0, video_fps=60, segment=None):
         assert (os.path.exists(directory)), f"The specified input directory is invalid {directory}"
 
         self.ui_mode = ui_mode
 
+        # Parsed montages are optionally kept between runs in the session directory
+        cache_path = os.path.join(directory, 'uilog', 'montages.cache') if persist_montages else None
+        self.montage_cache = MontageCache(cache_path)
+
+        # Setup UI log
+        self.ui_log_path = os.path.join(directory, 'uilog', 'ui_log.txt')
+        assert (os.path.exists(self.ui_log_path)), f"The specified ui log is invalid {self.ui_log_path}"
+
+        # When nobody is there to answer, find every edf the session opens now so a missing one fails before any work.
+        # The edfs are only read for the signals
+        self.headless = headless
+        edf_paths = resolve_session_edf_paths(self.ui_log_path, path_map) if self.headless and signals else None
+
         # State trackers
         if not self.ui_mode:
             self.eye = EyeState()
-        self.ui = UIState(multi=True, signals=signals)
-        self.ui_next = UIState()
+        self.ui = UIState(signals=signals, montage_cache=self.montage_cache, edf_paths=edf_paths, path_map=path_map,
+                          interactive=not self.headless)
         self.gaze_targets = []
         self.gaze_time = None
 
-        # Setup UI log
-        self.ui_log_path = os.path.join(directory, 'uilog', 'ui_log.txt')
-        assert (os.path.exists(self.ui_log_path)), f"The specified ui log is invalid {self.ui_log_path}"
         self.ui_log = open(self.ui_log_path, 'r')
         assert (self.ui_log.closed is False)
+        self.ui_cursor = LogCursor(self.ui_log, UI_TIMESTAMP)
 
         # Setup EYE log
         if not self.ui_mode:
             self.eye_log_path = os.path.join(directory, 'gaze_data.txt')
             assert (os.path.exists(self.eye_log_path)), f"The specified eye log is invalid {self.eye_log_path}"
-            self.eye.num_logs = sum(1 for line in open(self.eye_log_path))
+            self.eye_index = LogIndex.for_log(self.eye_log_path, GAZE_TIMESTAMP)
+            self.eye.num_logs = self.eye_index.num_entries
             assert self.eye.num_logs > 0, "There were no logs in the eye log"
             self.eye_log = open(self.eye_log_path, 'r')
             assert (self.eye_log.closed is False)
@@ -44,16 +65,19 @@ class PlayBack:
         # Setup montages directory
         self.ui.montages_directory = os.path.join(directory, 'uilog', 'montages')
         assert (os.path.exists(self.ui.montages_directory))
-        self.ui_next.montages_directory = os.path.join(directory, 'uilog', 'montages')
-        assert (os.path.exists(self.ui_next.montages_directory))
+        self.path_map = path_map
+        # Optionally only part of the session is rendered, to a video of its own, see segments.plan_segments
+        self.segment = segment
+        # The error that stopped the rendering part way through, if any
+        self.error = None
 
         # Setup images, dimensions and visualisations
         self.image_directory = os.path.join(directory, 'uilog', 'screenshots')
         assert (os.path.exists(self.image_directory))
-        image_name = f"0.png"
-        image_path = os.path.join(self.image_directory, image_name)
+        self.screenshots = ScreenshotCache(self.image_directory)
+        image_path = self.screenshots.path(0)
         assert os.path.exists(image_path), "Couldn't find the image to setup dimensions"
-        self.image_clean = cv2.imread(image_path)
+        self.image_clean = self.screenshots.get(0)
         assert self.image_clean is not None
         self.image_height, self.image_width, _ = self.image_clean.shape
         if not self.ui_mode:
@@ -61,6 +85,7 @@ class PlayBack:
             self.eye.image_height = self.image_height
         self.image_with_ui = None
         self.image_drawn = None
+        self.compositor = Compositor()
 
         # Display options
         self.playback = playback
@@ -68,9 +93,24 @@ class PlayBack:
             self.display_window = cv2.namedWindow("Analysis Playback", cv2.WINDOW_NORMAL)
         self.video = video
         if self.video:
-            fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-            self.writer = cv2.VideoWriter(os.path.join(os.path.dirname(self.ui_log_path), f"visualise.avi"), fourcc, 60,
-                                          (self.image_width, self.image_height))
+            assert video_codec in CODECS, f"Unknown video codec {video_codec}, choose from {', '.join(CODECS)}"
+            code, extension = CODECS[video_codec]
+            fourcc = cv2.VideoWriter_fourcc(*code)
+            self.video_path = os.path.join(os.path.dirname(self.ui_log_path), f"visualise{extension}")
+            if self.segment is not None:
+                self.video_path = self.segment['path']
+            # Frames are encoded on their own thread while the next ones are drawn
+            self.writer = VideoWriterThread(self.video_path, fourcc, video_fps, (self.image_width, self.image_height),
+                                            scale=video_scale)
+            # Each video frame covers 1 / video_fps seconds of the recording, the gaze samples within it are drawn
+            # together as a trail so the video plays at the speed it was recorded whatever the eye tracker rate
+            self.video_fps = video_fps
+            self.frame_compositor = Compositor()
+            self.frame_start = None
+            self.frame_index = 0
+            self.frame_trail = []
+            self.frame_content = None
+            self.frame_blank = None
 
         assert playback or video, "Need to specify an option to visualise"
         print(f"Visualising recording at {os.path.dirname(self.ui_log_path)}")
@@ -78,9 +118,6 @@ class PlayBack:
 
         self.signals = signals
 
-        self.ui_line = None
-        self.next_ui_line = None
-
         self.line_color = (0, 255, 0)
         self.line_width = 3
         self.font_color = (0, 0, 255)
@@ -110,7 +147,6 @@ class PlayBack:
             ui_entry = json.loads(line)
             self.ui.update(ui_entry)
             self.next_screenshot()
-            self.draw_ui()
             if self.image_with_ui is not None:
                 cv2.imwrite(os.path.join(visualise_path, f"{int(self.ui.log_id) + 1}.png"), self.image_with_ui)
                 if self.playback:
@@ -123,26 +159,33 @@ class PlayBack:
         :return:
         """
 
-        # Read the first line from ui log and initialise the state
-        self.next_ui_line = self.ui_log.readline()
-        ui_entry = json.loads(self.next_ui_line)
-        self.ui_next.update(ui_entry)
+        if self.segment is None or self.segment['ui_log_id'] is None:
+            # Read the first line from ui log, it is applied once the eye data reaches it
+            self.ui_cursor.advance()
 
-        # Read the first line from the eye log and initialise state
-        self.next_eye_log()
+            # Read the first line from the eye log and initialise state
+            self.next_eye_log()
 
-        # Throw away the UI tracking before EYE tracking is started
-        print("Skipping to start...")
-        while self.eye.time_stamp > self.ui_next.current_timestamp:
-            self.next_ui_log()
+            # Throw away the UI tracking before EYE tracking is started
+            print("Skipping to start...")
+            while self.eye.time_stamp > self.ui_cursor.next_timestamp:
+                self.next_ui_log()
+            eye_log_id = 1
+        else:
+            self.seek_segment()
+            eye_log_id = self.segment['start']
+        end = self.eye.num_logs if self.segment is None else self.segment['end']
 
         print("Begin visualisation.")
-        eye_log_id = 1
         try:
-            while self.next_eye_log():
+            while eye_log_id < end and self.next_eye_log():
+
+                # The new sample may be in a later video frame, finish the last one while the state is still its own
+                if self.video:
+                    self.next_frame()
 
                 # Read UI changes as time progresses according to the eye data
-                if self.eye.time_stamp > self.ui_next.current_timestamp:
+                if self.eye.time_stamp > self.ui_cursor.next_timestamp:
                     self.next_ui_log()
                     self.next_screenshot()
 
@@ -154,16 +197,39 @@ class PlayBack:
                 # Display / write
                 self.visualise()
 
-                sys.stdout.write(f"({eye_log_id}/{self.eye.num_logs})")
-                sys.stdout.flush()
-                sys.stdout.write('\r')
-                sys.stdout.flush()
+                if self.segment is None:
+                    sys.stdout.write(f"({eye_log_id}/{self.eye.num_logs})")
+                    sys.stdout.flush()
+                    sys.stdout.write('\r')
+                    sys.stdout.flush()
                 eye_log_id += 1
         except Exception as e:
             traceback.print_exc()
+            self.error = e
+            # A broken segment would be joined into the video unnoticed, so let the caller know
+            if self.segment is not None:
+                raise
         finally:
             if self.video:
-                self.writer.release()
+                try:
+                    # The last frame of a segment fills up to the first frame of the next one
+                    self.write_frame(1 if self.segment is None or self.segment['end_frame'] is None else
+                                     self.segment['end_frame'] - self.frame_index)
+                finally:
+                    self.writer.release()
+
+    def seek_segment(self):
+        """
+        Bring the logs and state to where a full run would be just before the first gaze sample of the segment, the
+        UI state from the nearest keyframe and the eye log from its index
+        """
+        keyframes = KeyframeIndex.for_session(self.ui_log_path, self.ui.montages_directory, path_map=self.path_map)
+        offset = keyframes.seek(self.ui, log_id=self.segment['ui_log_id'])
+        self.ui_log.seek(offset)
+        self.ui_cursor.advance()
+        self.eye_log.seek(int(self.eye_index.offsets[self.segment['start']]))
+        self.frame_start = self.segment['frame_start']
+        self.frame_index = self.segment['start_frame']
 
     def analyse_fixation_baselines(self):
         """
@@ -176,9 +242,10 @@ class PlayBack:
             # Iterate the channels in the ui state
             # If the signal baseline is within the range of the gaze point then it is currently fixated
             if self.ui.graph_top_left[0] < self.eye.center_gaze[0] < self.ui.graph_top_right[0]:
-                for channel in self.ui.channels:
-                        if self.eye.center_gaze[1] + 30 > channel.baseline > self.eye.center_gaze[1] - 30:
-                            self.gaze_targets.append(channel.label.strip())
+                baselines = self.ui.get_baselines()
+                fixated = numpy.nonzero((baselines < self.eye.center_gaze[1] + 30) & (baselines > self.eye.center_gaze[1] - 30))[0]
+                for i in fixated:
+                    self.gaze_targets.append(self.ui.channels[i].label.strip())
             else:
                 self.gaze_targets.append("Off")
 
@@ -205,13 +272,64 @@ class PlayBack:
         Reads the corresponding screenshot for the current UI log.
         :return:
         """
-        self.draw_eye()
-        if self.image_drawn is not None:
-            if self.playback:
+        if self.playback:
+            self.draw_eye()
+            if self.image_drawn is not None:
                 cv2.imshow("Analysis Playback", self.image_drawn)
                 cv2.waitKey(1)
-            if self.video:
-                self.writer.write(self.image_drawn)
+        if self.video:
+            self.frame_trail.append(self.eye.circles())
+
+    def next_frame(self):
+        """
+        Work out which video frame the current gaze sample falls in by its timestamp, writing the frame before it when
+        the sample is the first of a new one
+        """
+        if self.frame_start is None:
+            self.frame_start = self.eye.time_stamp
+        frame_index = int((self.eye.time_stamp - self.frame_start).total_seconds() * self.video_fps)
+        # Timestamps can step back a little, so a frame is only ever written once
+        if frame_index > self.frame_index:
+            self.write_frame(frame_index - self.frame_index)
+            self.frame_index = frame_index
+
+    def write_frame(self, count):
+        """
+        Draw the gaze samples gathered for a video frame over the current UI, the earlier ones as a faint trail, and
+        write it. Frames without samples, when the tracker skipped, repeat the frame before them. Every frame is written
+        so the video keeps to the time of the recording, before the UI is drawn e.g. ahead of the first UI event the
+        clean screenshot is used, or a blank frame if there is no screenshot either.
+        :param count: The number of frames to fill with this one
+        """
+        base = self.frame_base()
+        content = (self.frame_trail, list(self.gaze_targets), self.gaze_time)
+        if self.frame_compositor.base is not base or content != self.frame_content:
+            if self.frame_compositor.base is not base:
+                self.frame_compositor.set_base(base)
+            frame = self.frame_compositor.begin()
+            for circles in self.frame_trail[:-1]:
+                draw_circles(frame, circles, self.frame_compositor, thickness=1)
+            if self.frame_trail:
+                draw_circles(frame, self.frame_trail[-1], self.frame_compositor)
+            self.draw_gaze_target(frame, self.frame_compositor)
+            self.frame_content = content
+        # cv2 can not mark a frame as a repeat of the last one, so unchanged frames skip the drawing but are still
+        # encoded, which costs little for the codecs that only store the differences between frames
+        for _ in range(count):
+            self.writer.write(self.frame_compositor.frame)
+        self.frame_trail = []
+
+    def frame_base(self):
+        """
+        :return: The image the next video frame is drawn over, the screenshot with the UI if there is one
+        """
+        if self.image_with_ui is not None:
+            return self.image_with_ui
+        if self.image_clean is not None:
+            return self.image_clean
+        if self.frame_blank is None:
+            self.frame_blank = numpy.zeros((self.image_height, self.image_width, 3), dtype=numpy.uint8)
+        return self.frame_blank
 
     def draw_eye(self):
         """
@@ -219,9 +337,12 @@ class PlayBack:
         :return:
         """
         if self.image_with_ui is not None:
-            self.image_drawn = deepcopy(self.image_with_ui)
-            self.eye.draw(self.image_drawn)
-            self.draw_gaze_target(self.image_drawn)
+            # Only the areas under the last gaze overlay are restored, rather than copying the whole frame each sample
+            if self.compositor.base is not self.image_with_ui:
+                self.compositor.set_base(self.image_with_ui)
+            self.image_drawn = self.compositor.begin()
+            self.eye.draw(self.image_drawn, self.compositor)
+            self.draw_gaze_target(self.image_drawn, self.compositor)
 
     def draw_ui(self):
         """
@@ -229,26 +350,28 @@ class PlayBack:
         :return:
         """
         if self.image_clean is not None:
-            self.image_with_ui = deepcopy(self.image_clean)
+            # The clean screenshot is shared with the screenshot cache, so draw on a copy
+            self.image_with_ui = self.image_clean.copy()
             self.image_with_ui = self.ui.draw(self.image_with_ui)
 
-    def draw_gaze_target(self, image):
+    def draw_gaze_target(self, image, compositor=None):
         pos = 350
         step = 25
         string = ""
         for signal in self.gaze_targets:
             string += f"{signal}, "
-        image = cv2.putText(image, f"signals: {string}", (20, pos), self.font_type, self.font_scale,
-                            self.font_color, self.font_thick, cv2.LINE_AA)
-        pos += step
-        image = cv2.putText(image, f"gaze time: {self.gaze_time}", (20, pos), self.font_type, self.font_scale,
-                            self.font_color, self.font_thick, cv2.LINE_AA)
+        for text in (f"signals: {string}", f"gaze time: {self.gaze_time}"):
+            image = cv2.putText(image, text, (20, pos), self.font_type, self.font_scale, self.font_color,
+                                self.font_thick, cv2.LINE_AA)
+            if compositor is not None:
+                compositor.mark_text(text, (20, pos), self.font_type, self.font_scale, self.font_thick)
+            pos += step
         return image
 
     def next_screenshot(self):
-        image_name = f"{int(self.ui.log_id) + 1}.png"  # +1 because screenshot lag
-        image_path = os.path.join(self.image_directory, image_name)
-        self.image_clean = cv2.imread(image_path)
+        image_id = int(self.ui.log_id) + 1  # +1 because screenshot lag
+        self.image_clean = self.screenshots.get(image_id)
+        self.screenshots.prefetch(image_id)
         self.image_with_ui = None
         self.image_drawn = None
         self.draw_ui()
@@ -269,17 +392,12 @@ class PlayBack:
     def next_ui_log(self):
         """
         Reads the next line from the UI tracking log. Keeps track of the current log, and the log in front. Use the timestamp
-        from the next log to trigger changes in the playback.
+        from the next log to trigger changes in the playback. Only the timestamp of the log in front is decoded.
         :return:
         """
-        self.ui_line = self.next_ui_line
-        self.next_ui_line = self.ui_log.readline()
-        if self.next_ui_line is "":
+        if not self.ui_cursor.advance():
             return False
-        entry = json.loads(self.ui_line)
-        next_entry = json.loads(self.next_ui_line)
-        self.ui.update(entry)
-        self.ui_next.update(next_entry)
+        self.ui.update(json.loads(self.ui_cursor.line))
         return True
 
     def finish(self):
@@ -290,3 +408,5 @@ class PlayBack:
         self.ui_log.close()
         if not self.ui_mode:
             self.eye_log.close()
+        self.screenshots.close()
+        self.montage_cache.save()
@@ -1,6 +1,6 @@
 import argparse
 
-from playback_analysis import PlayBack
+from paths import parse_path_map
 
 
 if __name__ == "__main__":
@@ -9,9 +9,18 @@ if __name__ == "__main__":
     parser.add_argument("--input", help="A directory containing the UI and eye tracking data.")
     parser.add_argument("--playback", dest='playback', action='store_true', help="Playback and view the recording")
     parser.add_argument("--video", dest='video', action='store_true', help="Create a video file from the recording")
+    parser.add_argument("--codec", dest="codec", default="mp4v", choices=["mp4v", "xvid", "mjpg"], help="The codec of the --video file, mp4v and xvid are far smaller than mjpg")
+    parser.add_argument("--scale", dest="scale", type=float, default=1.0, help="Shrink the --video frames by this factor e.g. 0.5 for half the width and height")
+    parser.add_argument("--fps", dest="fps", type=float, default=60, help="The frame rate of the --video file")
+    parser.add_argument("--workers", dest="workers", type=int, default=None, help="Render a --video in segments on this many processes, which needs ffmpeg to join them, defaults to 1. With --all the number of recordings processed at once, defaults to the number of CPUs")
     parser.add_argument("--signals", dest="signals", action="store_true", help="Reproject and track the eeg signals instead of baselines")
     parser.add_argument("--ui", dest="ui", action="store_true", help="Process UI tracking data only")
-    parser.add_argument("--all", dest='all', action='store_true', help="Create a video for each recording in the mirror directory")
+    parser.add_argument("--persist-montages", dest="persist_montages", action="store_true", help="Keep the parsed montages in the session directory for later runs")
+    parser.add_argument("--headless", dest="headless", action="store_true", help="Never stop to ask for input, fail straight away if an edf file can not be found")
+    parser.add_argument("--path-map", dest="path_map", action="append", metavar="OLD=NEW", help="Replace the root OLD of the edf paths in the logs with NEW, can be given more than once")
+    parser.add_argument("--analyse", dest="analyse", action="store_true", help="Only work out the fixated channels and gaze times and save them, without rendering")
+    parser.add_argument("--output", dest="output", help="Where --analyse writes its results, .npz or .csv. Defaults to fixations.npz in the input directory")
+    parser.add_argument("--all", dest='all', action='store_true', help="Create a video, or the --analyse results, for each recording under the --input mirror directory, in parallel and skipping those already done")
     args = parser.parse_args()
 
     # Debugging
@@ -22,6 +31,26 @@ if __name__ == "__main__":
     # args.signals = False
     # args.ui = True
     print(f"Running TEETACSI data processing")
-    playback = PlayBack(args.input, args.playback, args.video, args.signals, args.ui)
-    playback.finish()
+    # Imported after the arguments are read so --help and bad arguments do not wait for cv2 and numpy to load
+    segmented = args.video and not (args.all or args.analyse or args.playback or args.ui) and (args.workers or 1) > 1
+    if segmented:
+        from segments import can_concatenate, render_session
+        if not can_concatenate():
+            print("ffmpeg was not found to join the segments of the video, rendering it on one process")
+            segmented = False
+    if args.all:
+        from batch import process_all
+        process_all(args.input, args.analyse, args.workers, args.signals, args.persist_montages,
+                    parse_path_map(args.path_map), args.codec, args.scale, args.fps)
+    elif args.analyse:
+        from fixations import analyse_session
+        analyse_session(args.input, args.output, args.persist_montages, parse_path_map(args.path_map), args.headless)
+    elif segmented:
+        render_session(args.input, args.workers, args.signals, args.persist_montages, parse_path_map(args.path_map),
+                       args.headless, args.codec, args.scale, args.fps)
+    else:
+        from playback_analysis import PlayBack
+        playback = PlayBack(args.input, args.playback, args.video, args.signals, args.ui, args.persist_montages,
+                            parse_path_map(args.path_map), args.headless, args.codec, args.scale, args.fps)
+        playback.finish()
     print(f"Done")
\ No newline at end of file
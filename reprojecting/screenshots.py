@@ -0,0 +1,69 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+
+
+class ScreenshotCache:
+
+    def __init__(self, image_directory, capacity=32, prefetch=8, workers=2):
+        """
+        Decodes the screenshots ahead of playback on background threads and keeps the most recently used ones, so the
+        main loop does not wait on PNG decoding when the UI changes. cv2 releases the GIL while decoding, so the
+        threads decode alongside the drawing.
+        :param image_directory: The directory of screenshots named by id e.g. 12.png
+        :param capacity: The most decoded screenshots to keep, including those being prefetched
+        :param prefetch: How many screenshots ahead to decode
+        :param workers: The number of decoding threads
+        """
+        self.image_directory = image_directory
+        self.capacity = max(capacity, prefetch + 1)
+        self.prefetch_count = prefetch
+        self.frames = OrderedDict()
+        self.pool = ThreadPoolExecutor(max_workers=workers) if prefetch > 0 else None
+
+    def path(self, image_id):
+        return os.path.join(self.image_directory, f"{image_id}.png")
+
+    def decode(self, image_id):
+        return cv2.imread(self.path(image_id))
+
+    def get(self, image_id):
+        """
+        :param image_id: The screenshot id
+        :return: The decoded screenshot, or None if it could not be read. The cached array is shared, copy it before
+                 drawing on it
+        """
+        if image_id in self.frames:
+            self.frames.move_to_end(image_id)
+            frame = self.frames[image_id]
+        else:
+            frame = self.decode(image_id)
+            self.frames[image_id] = frame
+            self.evict()
+        if isinstance(frame, Future):
+            frame = frame.result()
+            self.frames[image_id] = frame
+        return frame
+
+    def prefetch(self, image_id):
+        """
+        Start decoding the screenshots following one in the background
+        :param image_id: The screenshot being shown now
+        """
+        if self.pool is None:
+            return
+        for next_id in range(image_id + 1, image_id + 1 + self.prefetch_count):
+            if next_id not in self.frames and os.path.exists(self.path(next_id)):
+                self.frames[next_id] = self.pool.submit(self.decode, next_id)
+        self.evict()
+
+    def evict(self):
+        while len(self.frames) > self.capacity:
+            self.frames.popitem(last=False)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
@@ -0,0 +1,162 @@
+import datetime
+import json
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from fixations import applied_events, gaze_timestamps
+from keyframes import KeyframeIndex
+from logindex import LogIndex, extract_timestamp
+from paths import resolve_session_edf_paths
+from timestamps import TimestampParser, GAZE_TIMESTAMP, UI_TIMESTAMP, to_microseconds
+from videowriter import CODECS
+
+# More segments than workers, so a worker that finishes early picks up another rather than waiting on the slowest
+SEGMENTS_PER_WORKER = 2
+# Segments shorter than this in seconds of recording spend more time seeking than rendering
+MIN_SEGMENT_SECONDS = 10
+
+
+def plan_segments(directory, num_segments, video_fps, extension, path_map=None):
+    """
+    Split a session into segments that can be rendered separately and joined into the same video a full run makes.
+    Each segment starts at a gaze sample where PlayBack applies a UI event and starts a new video frame, so no frame
+    is shared between two segments. The UI state and frame numbering at the start of each segment are worked out
+    here, the same way FixationAnalysis follows PlayBack, so the renderer can seek straight to it.
+    :param directory: The session directory
+    :param num_segments: The most segments to split into, fewer if the session is short
+    :param video_fps: The frame rate of the video
+    :param extension: The extension of the video files e.g. .mp4
+    :param path_map: A list of (old root, new root) pairs for edf paths recorded on another machine
+    :return: A list of segment dictionaries for PlayBack, in order
+    """
+    ui_log_path = os.path.join(directory, 'uilog', 'ui_log.txt')
+    eye_log_path = os.path.join(directory, 'gaze_data.txt')
+
+    # The renderers only load these, build them once here rather than in every one of them
+    KeyframeIndex.for_session(ui_log_path, os.path.join(directory, 'uilog', 'montages'), path_map=path_map)
+    LogIndex.for_log(eye_log_path, GAZE_TIMESTAMP)
+
+    with open(ui_log_path, 'rb') as log:
+        ui_lines = [line for line in log.read().splitlines() if line.strip()]
+    ui_log_ids = [json.loads(line)['id'] for line in ui_lines]
+    ui_stamps = to_microseconds(TimestampParser(UI_TIMESTAMP).parse_column([extract_timestamp(line)
+                                                                            for line in ui_lines]))
+    with open(eye_log_path, 'rb') as log:
+        gaze = gaze_timestamps([extract_timestamp(line) for line in log.read().splitlines() if line.strip()])
+    applied = applied_events(ui_stamps, gaze)
+
+    # The video frame of each sample from the first one shown, and the last frame written before it
+    frames = numpy.zeros(len(gaze), dtype=numpy.int64)
+    frames[1:] = ((gaze[1:] - gaze[1]) / 1e6 * video_fps).astype(numpy.int64)
+    written = numpy.zeros(len(gaze), dtype=numpy.int64)
+    written[1:] = numpy.maximum.accumulate(numpy.maximum(frames[1:], 0))
+
+    candidates = numpy.flatnonzero((applied[2:] > applied[1:-1]) & (applied[1:-1] > 0) &
+                                   (frames[2:] > written[1:-1])) + 2
+    duration = (gaze[-1] - gaze[1]) / 1e6 if len(gaze) > 1 else 0
+    num_segments = max(1, min(num_segments, int(duration // MIN_SEGMENT_SECONDS)))
+    starts = []
+    if len(candidates):
+        targets = 1 + numpy.arange(1, num_segments) * (len(gaze) - 1) / num_segments
+        picks = numpy.minimum(numpy.searchsorted(candidates, targets), len(candidates) - 1)
+        starts = sorted(set(candidates[picks].tolist()))
+
+    frame_start = numpy.datetime64(int(gaze[1]), 'us').astype(datetime.datetime) if len(gaze) > 1 else None
+    bounds = [1] + starts + [len(gaze)]
+    segments = []
+    for k in range(len(bounds) - 1):
+        start, end = bounds[k], bounds[k + 1]
+        segments.append({
+            'start': start,
+            'end': end,
+            # The first segment starts the same way a full run does
+            'ui_log_id': None if k == 0 else ui_log_ids[applied[start - 1] - 1],
+            'frame_start': frame_start,
+            # The frame of the first sample, the frames before it are written by the segment before
+            'start_frame': int(frames[start]),
+            'end_frame': None if end == len(gaze) else int(frames[end]),
+            'path': os.path.join(directory, 'uilog', f"visualise.part{k}{extension}"),
+        })
+    return segments
+
+
+def render_segment(directory, segment, options):
+    """
+    Render one segment in a worker process
+    :param directory: The session directory
+    :param segment: A segment dictionary from plan_segments
+    :param options: Keyword arguments for PlayBack
+    :return: The path of the segment's video
+    """
+    from playback_analysis import PlayBack
+    playback = PlayBack(directory, video=True, segment=segment, **options)
+    playback.finish()
+    return segment['path']
+
+
+def render_session(directory, workers, signals=False, persist_montages=False, path_map=None, headless=False,
+                   video_codec='mp4v', video_scale=1.0, video_fps=60):
+    """
+    Render the video of a session on several processes, each rendering segments of it from where the UI log and eye
+    log are at the segment start, then join the segments into the one video
+    :param directory: The session directory
+    :param workers: The number of processes
+    :return: The path of the video
+    """
+    assert (os.path.exists(directory)), f"The specified input directory is invalid {directory}"
+    if headless and signals:
+        # Fail before starting the renderers if an edf they need is missing
+        resolve_session_edf_paths(os.path.join(directory, 'uilog', 'ui_log.txt'), path_map)
+    extension = CODECS[video_codec][1]
+    segments = plan_segments(directory, workers * SEGMENTS_PER_WORKER, video_fps, extension, path_map)
+    print(f"Rendering {directory} in {len(segments)} segments on {workers} processes")
+    options = dict(signals=signals, persist_montages=persist_montages, path_map=path_map, headless=headless,
+                   video_codec=video_codec, video_scale=video_scale, video_fps=video_fps)
+    output_path = os.path.join(directory, 'uilog', f"visualise{extension}")
+    paths = [segment['path'] for segment in segments]
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(segments))) as pool:
+            list(pool.map(render_segment, [directory] * len(segments), segments, [options] * len(segments)))
+        if len(paths) == 1:
+            os.replace(paths[0], output_path)
+        else:
+            concatenate(paths, output_path)
+    finally:
+        # Whether or not the join worked, the segments are not left in the recording directory
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    return output_path
+
+
+def can_concatenate():
+    """
+    :return: True if ffmpeg is on the path to join segments with. Without it the segments would have to be decoded and
+             encoded again, which costs more than rendering them in parallel saves and loses quality
+    """
+    return shutil.which('ffmpeg') is not None
+
+
+def concatenate(paths, output_path):
+    """
+    Join videos end to end with ffmpeg, which copies the encoded frames across as they are
+    :param paths: The videos to join, in order
+    :param output_path: The video to write
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    assert ffmpeg is not None, "ffmpeg is needed to join the segments of a video"
+    list_path = f"{output_path}.parts.txt"
+    try:
+        with open(list_path, 'w') as f:
+            for path in paths:
+                escaped = os.path.abspath(path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                        '-c', 'copy', output_path], check=True)
+    finally:
+        if os.path.exists(list_path):
+            os.remove(list_path)
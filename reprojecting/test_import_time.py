@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+
+# The modules the fixation analysis needs, which should load without any of the drawing or parsing libraries
+ANALYSIS_MODULES = ('uistate', 'fixations', 'montage', 'channel')
+# Only imported when something is drawn, a montage is parsed or a file has to be asked for
+DEFERRED_MODULES = ('cv2', 'scipy', 'lxml', 'PyQt5')
+# Seconds, well above what the imports take so a slow machine does not fail it, but far below loading cv2 and scipy
+IMPORT_BUDGET = 1.5
+
+SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import {', '.join(ANALYSIS_MODULES)}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {DEFERRED_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def import_analysis_modules():
+    """
+    Import the analysis modules in a fresh interpreter, so nothing already imported by the tests is counted
+    :return: The seconds the imports took and the deferred modules that were loaded
+    """
+    result = subprocess.run([sys.executable, '-c', SCRIPT], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_heavy_imports_are_deferred():
+    assert import_analysis_modules()['loaded'] == []
+
+
+def test_import_time_budget():
+    elapsed = import_analysis_modules()['elapsed']
+    assert elapsed < IMPORT_BUDGET, f"Importing {', '.join(ANALYSIS_MODULES)} took {elapsed:.2f}s"
@@ -0,0 +1,212 @@
+from datetime import datetime
+
+import numpy
+
+
+class TimestampFormat:
+
+    def __init__(self, formats, year, month, day, separators):
+        """
+        Describes where each field sits in a fixed width timestamp so it can be sliced out instead of going through
+        strptime. The time of day is laid out the same way in both logs, HH:MM:SS at 11 followed by a separator and an
+        optional fraction of a second from 20.
+        :param formats: The strptime formats to fall back on, tried in order
+        :param year: (start, stop) of the year
+        :param month: (start, stop) of the month
+        :param day: (start, stop) of the day
+        :param separators: The first 20 characters of the layout, with # for a digit e.g. "##.##.#### ##:##:##:"
+        """
+        self.formats = formats
+        self.year = year
+        self.month = month
+        self.day = day
+        self.hour = (11, 13)
+        self.minute = (14, 16)
+        self.second = (17, 19)
+        self.fraction = 20
+        self.separators = separators
+
+
+# e.g. 27.01.2021 13:59:42:123
+UI_TIMESTAMP = TimestampFormat(("%d.%m.%Y %H:%M:%S:%f",), (6, 10), (3, 5), (0, 2), "##.##.#### ##:##:##:")
+# e.g. 2021-01-27 13:59:42.123456 or 2021-01-27 13:59:42
+GAZE_TIMESTAMP = TimestampFormat(("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"), (0, 4), (5, 7), (8, 10),
+                                 "####-##-## ##:##:##.")
+
+
+class TimestampParser:
+
+    def __init__(self, timestamp_format):
+        """
+        Parses the timestamps of one log. The layout is checked against strptime on the first timestamp, after that
+        every timestamp is read by slicing at the fixed offsets and only falls back to strptime if that fails.
+        :param timestamp_format: A TimestampFormat describing the log e.g. UI_TIMESTAMP or GAZE_TIMESTAMP
+        """
+        self.format = timestamp_format
+        self.fixed = None
+
+    def parse(self, timestamp):
+        """
+        Convert a timestamp string from the log
+        :param timestamp: e.g. "27.01.2021 13:59:42:123"
+        :return: A datetime, raises ValueError if the timestamp can not be read
+        """
+        if self.fixed is None:
+            self.fixed = self.detect(timestamp)
+        if self.fixed:
+            try:
+                return self.parse_fixed(timestamp)
+            except ValueError:
+                pass
+        return self.parse_strptime(timestamp)
+
+    def detect(self, timestamp):
+        """
+        Check that slicing the timestamp at the fixed offsets gives the same answer as strptime
+        :param timestamp: The first timestamp from the log
+        :return: True if the fixed offsets can be used for this log
+        """
+        try:
+            return self.parse_fixed(timestamp) == self.parse_strptime(timestamp)
+        except ValueError:
+            return False
+
+    def parse_fixed(self, timestamp):
+        fmt = self.format
+        if len(timestamp) > fmt.fraction:
+            if timestamp[fmt.fraction - 1] != fmt.separators[fmt.fraction - 1]:
+                raise ValueError(f"Unexpected timestamp layout {timestamp}")
+            fraction = timestamp[fmt.fraction:]
+            if len(fraction) > 6 or not fraction.isdigit():
+                raise ValueError(f"Unexpected timestamp layout {timestamp}")
+            microsecond = int(fraction) * 10 ** (6 - len(fraction))
+        elif len(timestamp) == fmt.fraction - 1:
+            microsecond = 0
+        else:
+            raise ValueError(f"Unexpected timestamp layout {timestamp}")
+        return datetime(int(timestamp[fmt.year[0]:fmt.year[1]]), int(timestamp[fmt.month[0]:fmt.month[1]]),
+                        int(timestamp[fmt.day[0]:fmt.day[1]]), int(timestamp[fmt.hour[0]:fmt.hour[1]]),
+                        int(timestamp[fmt.minute[0]:fmt.minute[1]]), int(timestamp[fmt.second[0]:fmt.second[1]]),
+                        microsecond)
+
+    def parse_strptime(self, timestamp):
+        for f in self.format.formats:
+            try:
+                return datetime.strptime(timestamp, f)
+            except ValueError:
+                pass
+        raise ValueError(f"Timestamp {timestamp} does not match {self.format.formats}")
+
+    def parse_column(self, timestamps):
+        """
+        Convert a whole column of timestamps at once. The fixed width fields are read straight out of the characters
+        with numpy, any timestamps that do not fit the layout are parsed one at a time.
+        :param timestamps: A sequence of timestamp strings from the log
+        :return: A numpy datetime64[us] array, NaT where a timestamp could not be read. Use to_microseconds() for int64
+        """
+        fmt = self.format
+        result = numpy.full(len(timestamps), numpy.datetime64('NaT'), dtype='datetime64[us]')
+        if len(timestamps) == 0:
+            return result
+        raw = numpy.array(timestamps, dtype=numpy.bytes_)
+        width = raw.dtype.itemsize
+        if width < fmt.fraction - 1:
+            valid = numpy.zeros(len(timestamps), dtype=bool)
+        else:
+            chars = raw.view(numpy.uint8).reshape(len(timestamps), width)
+            digits = chars.astype(numpy.int64) - ord('0')
+            is_digit = (digits >= 0) & (digits <= 9)
+
+            # Digits and separators where the layout expects them
+            valid = numpy.ones(len(timestamps), dtype=bool)
+            for i, c in enumerate(fmt.separators[:fmt.fraction - 1]):
+                valid &= is_digit[:, i] if c == '#' else chars[:, i] == ord(c)
+
+            # Then either nothing, or the fraction separator followed by 1-6 digits
+            fraction = numpy.zeros(len(timestamps), dtype=numpy.int64)
+            if width > fmt.fraction - 1:
+                has_fraction = chars[:, fmt.fraction - 1] != 0
+                valid &= ~has_fraction | (chars[:, fmt.fraction - 1] == ord(fmt.separators[fmt.fraction - 1]))
+                tail = chars[:, fmt.fraction:fmt.fraction + 6]
+                padding = tail == 0
+                valid &= numpy.all(is_digit[:, fmt.fraction:fmt.fraction + 6] | padding, axis=1)
+                if tail.shape[1] > 0:
+                    valid &= ~has_fraction | ~padding[:, 0]
+                else:
+                    valid &= ~has_fraction
+                if width > fmt.fraction + 6:
+                    valid &= numpy.all(chars[:, fmt.fraction + 6:] == 0, axis=1)
+                scale = 10 ** numpy.arange(5, 5 - tail.shape[1], -1, dtype=numpy.int64)
+                fraction = (numpy.where(padding, 0, digits[:, fmt.fraction:fmt.fraction + 6]) * scale).sum(axis=1)
+
+            def field(span):
+                scale = 10 ** numpy.arange(span[1] - span[0] - 1, -1, -1, dtype=numpy.int64)
+                return (numpy.where(is_digit[:, span[0]:span[1]], digits[:, span[0]:span[1]], 0) * scale).sum(axis=1)
+
+            year, month, day = field(fmt.year), field(fmt.month), field(fmt.day)
+            hour, minute, second = field(fmt.hour), field(fmt.minute), field(fmt.second)
+            valid &= (month >= 1) & (month <= 12) & (day >= 1) & (hour <= 23) & (minute <= 59) & (second <= 59)
+            months = (year - 1970) * 12 + numpy.clip(month, 1, 12) - 1
+            month_start = months.astype('datetime64[M]')
+            valid &= day <= ((month_start + 1).astype('datetime64[D]') - month_start.astype('datetime64[D]')).astype(numpy.int64)
+            days = month_start.astype('datetime64[D]') + (day - 1)
+            micros = ((hour * 60 + minute) * 60 + second) * 1000000 + fraction
+            result[valid] = days[valid].astype('datetime64[us]') + micros[valid]
+
+        # Anything that did not fit the layout goes through the slower path
+        for i in numpy.nonzero(~valid)[0]:
+            try:
+                result[i] = numpy.datetime64(self.parse(timestamps[i]), 'us')
+            except ValueError:
+                pass
+        return result
+
+
+def to_microseconds(column):
+    """
+    :param column: A numpy datetime64[us] array e.g. from TimestampParser.parse_column
+    :return: The same times as int64 microseconds since the epoch
+    """
+    return column.astype('datetime64[us]').view(numpy.int64)
+
+
+def clock_to_seconds(clock):
+    """
+    :param clock: A H:M:S or M:S string, optionally with a sign and a fraction of a second e.g. -0:00:02.500
+    :return: The time in seconds as a float
+    """
+    sign = 1
+    if clock.startswith('-'):
+        sign = -1
+        clock = clock[1:]
+    seconds = 0.0
+    for part in clock.split(':'):
+        seconds = seconds * 60 + float(part)
+    return sign * seconds
+
+
+def time_position_to_seconds(time_position):
+    """
+    The time position is recorded from EDFBrowser as a string e.g. 0:00:10 (0:00:10), the time into the recording is
+    in brackets.
+    :param time_position: The time position string from the log
+    :return: The time in seconds as a float, negative if the page starts before the recording
+    """
+    if '(' in time_position:
+        time_position = time_position.split('(')[1]
+    return clock_to_seconds(time_position.strip().strip(')'))
+
+
+def timescale_to_seconds(time_scale):
+    """
+    The timescale is recorded from EDFBrowser as a string e.g. 10 sec, 500 mS or 1:00
+    :param time_scale: The timescale string from the log
+    :return: The length of the page in seconds as a float
+    """
+    if "uS" in time_scale:
+        return float(time_scale.replace("uS", "")) / 1000000
+    elif "mS" in time_scale:
+        return float(time_scale.replace("mS", "")) / 1000
+    elif "sec" in time_scale:
+        return float(time_scale.replace("sec", ""))
+    return clock_to_seconds(time_scale.strip())
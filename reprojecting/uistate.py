@@ -1,36 +1,56 @@
-import math
 import os
-import sys
-import time
-import traceback
-from datetime import datetime
-import multiprocessing
 
-import cv2
 import numpy
-from PyQt5.QtWidgets import QApplication
-from channel import Channel
+from channelbuffer import ChannelBuffer
 from edfreader import EDFreader
-from filter_class import FidFilter
-from lxml import etree
+from montage import MontageCache
+from paths import resolve_edf_path
+from timestamps import TimestampParser, UI_TIMESTAMP, time_position_to_seconds, timescale_to_seconds
 
+# Imported by load_cv2 when a state is first drawn, so a state that is only followed e.g. for the fixation analysis
+# never loads it
+cv2 = None
+
+# Derived state that events can invalidate, see UIState.refresh
+CHANNELS = 'channels'
+CHANNEL_DATA = 'channel_data'
+BASELINES = 'baselines'
+
+# The state recorded from the log, everything else can be rebuilt from these, see UIState.snapshot
+SNAPSHOT_FIELDS = ('log_id', 'last_event', 'current_timestamp', 'graph_width', 'graph_height', 'graph_top_left',
+                   'graph_top_right', 'graph_bottom_left', 'graph_bottom_right', 'time_position', 'time_scale',
+                   'opened', 'edf_file_path', 'montage_file_name')
 
-class UIState:
 
-    def __del__(self):
-        if self.multi and self.signals is True:
-            self.pool.close()
-            self.pool.join()
+def load_cv2():
+    """
+    Import cv2 into this module the first time a state is drawn
+    :return: The cv2 module
+    """
+    global cv2
+    if cv2 is None:
+        import cv2
+    return cv2
 
-    def __init__(self, montages_directory=None, multi=False, signals=False):
+
+class UIState:
+
+    def __init__(self, montages_directory=None, signals=False, montage_cache=None, edf_paths=None, path_map=None,
+                 interactive=True):
         """
         Reconstructs the state and tracks the changes in a UI log file
         :param montages_directory: Need to specify the location of the corresponding montages that were saved with the log.
                                     These are used to reconstruct filters, baselines, active channels etc.
+        :param signals: Load and draw the EEG signals as well as the baselines
+        :param montage_cache: A MontageCache to share parsed montages with other states. A private one is used if None
+        :param edf_paths: A dictionary from edf paths in the log to where they are on this machine, see paths.py
+        :param path_map: A list of (old root, new root) pairs to remap edf paths not in edf_paths
+        :param interactive: Ask for the edf if it can not be found. If False a FileNotFoundError is raised instead
         """
         self.log_id = None
         self.last_event = None
         self.current_timestamp = None
+        self.timestamp_parser = TimestampParser(UI_TIMESTAMP)
         self.graph_width = None
         self.graph_height = None
         self.graph_top_left = None
@@ -41,141 +61,208 @@ class UIState:
         self.time_scale = None
         self.num_channels = None
         self.channels = []
+        self.baselines = numpy.empty(0, dtype=numpy.int64)
         self.opened = False
+        self.edf_file_path = None
+        # Only opened once the signals are needed, see refresh()
+        self.edf = None
+        self.edf_paths = dict(edf_paths) if edf_paths is not None else {}
+        self.path_map = path_map if path_map is not None else []
+        self.interactive = interactive
         self.signals = signals
 
         self.montages_directory = montages_directory
         self.montage_file_name = None
         self.montage_file_path = None
+        self.montage_cache = montage_cache if montage_cache is not None else MontageCache()
+
+        # Derived state invalidated by the events applied since the last refresh
+        self.dirty = set()
+        self.handlers = {
+            'FILE_OPENED': self.on_file_opened,
+            'FILE_CLOSED': self.on_file_closed,
+            'MONTAGE_CHANGED': self.on_montage_changed,
+            'CHANNELS_CHANGED': self.on_montage_file,
+            'FILTER_CHANGED': self.on_montage_file,
+            'AMPLITUDE_CHANGED': self.on_montage_file,
+            'VERTICAL_CHANGED': self.on_montage_file,
+            'TIMESCALE_CHANGED': self.on_timescale_changed,
+            'TIME_POSITION_CHANGED': self.on_time_position_changed,
+            'ZOOM_CHANGED': self.on_zoom_changed,
+            'WINDOW_MOVED': self.on_window_moved,
+            'GRAPH_RESIZED': self.on_graph_resized,
+            'MODAL_OPENED': self.on_view_changed,
+            'MODAL_CLOSED': self.on_view_changed,
+            'MENU_OPENED': self.on_view_changed,
+            'MENU_SEARCH': self.on_view_changed,
+            'MENU_CLOSED': self.on_view_changed,
+            'WINDOW_MINIMISED': self.on_view_changed,
+            'WINDOW_MAXIMISED': self.on_view_changed,
+            'WINDOW_OPENED': self.on_view_changed,
+            'WINDOW_FULLSCREEN': self.on_view_changed,
+        }
 
         self.line_color = (0, 255, 0)
         self.line_width = 3
         self.font_color = (0, 0, 255)
         self.font_scale = 2
         self.font_thick = 2
-        self.font_type = cv2.FONT_HERSHEY_PLAIN
+        # Set from cv2 by draw, which is where cv2 is first needed
+        self.font_type = None
 
-        self.multi = multi
-        if self.multi and self.signals:
-            self.num_cores = multiprocessing.cpu_count()
-            lock = multiprocessing.Lock()
-            self.pool = multiprocessing.Pool(initializer=self.init, processes=self.num_cores, initargs=(lock,))
+        self.channel_buffer = ChannelBuffer()
+        # The (time position, timescale, number of channels) the channel buffer was last filled for
+        self.channel_window = None
+
+        # Reduce the signals to per column min/max once there are this many samples for each pixel column
+        self.decimate_ratio = 8
 
     def update(self, entry):
         """
-        Read an entry from the UI log file and reconstruct the state using the information
+        Read an entry from the UI log file and reconstruct the state using the information. The handlers only record
+        what changed, anything derived from it is marked dirty and brought up to date by refresh().
         :param entry: A line from the UI log loaded into a dictionary
         :return: False if the entry was "FILE_CLOSED"
         """
         event = entry['event']
-        if "data" in entry:
-            data = entry['data']
+        data = entry.get('data')
         self.log_id = entry['id']
         timestamp = entry['timestamp']
-        self.current_timestamp = datetime.strptime(timestamp, "%d.%m.%Y %H:%M:%S:%f")
-        
+        self.current_timestamp = self.timestamp_parser.parse(timestamp)
+
         # Update the state according the recorded events
-        if event == 'FILE_OPENED':
-            self.edf_file_path = data['edf_path']
-            self.time_position = data['time']
-            self.time_scale = data['time_scale']
-            self.graph_width = data['graph_dimensions'][0]
-            self.graph_height = data['graph_dimensions'][1]
-            graph_box = data['graph_box']
-            self.graph_top_left = (graph_box['top_left'][0], graph_box['top_left'][1])
-            self.graph_top_right = (graph_box['top_right'][0], graph_box['top_right'][1])
-            self.graph_bottom_left = (graph_box['bottom_left'][0], graph_box['bottom_left'][1])
-            self.graph_bottom_right = (graph_box['bottom_right'][0], graph_box['bottom_right'][1])
-            self.last_event = 'FILE_OPENED'
-            self.montage_file_name = data['montage_file']
-            print("Reading edf file")
-            if os.path.exists(self.edf_file_path):
-                self.edf = EDFreader(self.edf_file_path)
-            else:
-                user_input = input(f"The path to the edf file ({self.edf_file_path}) is invalid. Please specify the path"
-                                   f"to the edf file. ")
-                assert os.path.exists(user_input), f"The path {user_input} does not lead to a valid edf file."
-                self.edf = EDFreader(self.edf_file_path)
-            assert self.edf is not None
-            self.load_channels_from_montage()
-            self.opened = True
-        elif event == 'FILE_CLOSED':
+        handler = self.handlers.get(event)
+        if handler is None:
+            print("Invalid event!")
+            return
+        if handler(data) is False:
             return False
-        elif event == 'MONTAGE_CHANGED':
-            self.montage_file_name = data['montage_file']
-            self.time_scale = data['time']
-            self.load_channels_from_montage()
-            self.last_event = 'MONTAGE_CHANGED'
-        elif event == 'CHANNELS_CHANGED':
-            self.montage_file_name = data['montage_file']
-            self.load_channels_from_montage()
-            self.last_event = 'CHANNELS_CHANGED'
-        elif event == 'FILTER_CHANGED':
-            self.montage_file_name = data['montage_file']
-            self.load_channels_from_montage()
-            self.last_event = 'FILTER_CHANGED'
-        elif event == 'AMPLITUDE_CHANGED':
-            self.montage_file_name = data['montage_file']
-            self.load_channels_from_montage()
-            self.last_event = 'AMPLITUDE CHANGED'
-        elif event == 'TIMESCALE_CHANGED':
-            self.time_scale = data['time_scale']
-            self.time_position = data['time']
-            if self.opened and self.signals: self.update_channels()
-            self.last_event = 'TIMESCALE_CHANGED'
-        elif event == 'TIME_POSITION_CHANGED':
-            self.time_position = data['time']
-            if self.opened and self.signals: self.update_channels()
-            self.last_event = 'TIME_POSITION_CHANGED'
-        elif event == 'VERTICAL_CHANGED':
-            self.montage_file_name = data['montage_file']
-            self.load_channels_from_montage()
-            self.last_event = 'VERTICAL_CHANGED'
-        elif event == 'ZOOM_CHANGED':
-            self.montage_file_name = data['montage_file']
+        self.last_event = event
+
+    def snapshot(self):
+        """
+        Capture the state recorded from the log so far, without anything derived from it. The channels, baselines and
+        signal data are rebuilt from this by refresh() after a restore, so the snapshot stays small.
+        :return: A dictionary of plain values that can be pickled, see restore()
+        """
+        return {field: getattr(self, field) for field in SNAPSHOT_FIELDS}
+
+    def restore(self, snapshot):
+        """
+        Put the state back to a snapshot taken by snapshot(). The edf is only reopened if it is a different file.
+        :param snapshot: A dictionary from snapshot()
+        """
+        previous_edf = self.edf_file_path if self.opened else None
+        for field in SNAPSHOT_FIELDS:
+            setattr(self, field, snapshot[field])
+        if self.opened and self.edf_file_path != previous_edf:
+            self.edf = None
+        self.montage_file_path = None
+        self.channels = []
+        self.baselines = numpy.empty(0, dtype=numpy.int64)
+        self.dirty = {CHANNELS, BASELINES, CHANNEL_DATA}
+
+    def refresh(self):
+        """
+        Recompute whatever the events since the last refresh have invalidated. Called before the state is drawn or
+        analysed, so a run of events only costs one montage load and one read of the edf.
+        """
+        if not self.dirty:
+            return
+        if CHANNELS in self.dirty:
             self.load_channels_from_montage()
-            if self.opened and self.signals: self.update_channels()
-            self.time_scale = data['time_scale']
-            self.time_position = data['time']
-            self.last_event = 'ZOOM_CHANGED'
-        elif entry['event'] == 'WINDOW_MOVED':
-            graph_box = data['graph_box']
-            self.graph_top_left = (graph_box['top_left'][0], graph_box['top_left'][1])
-            self.graph_top_right = (graph_box['top_right'][0], graph_box['top_right'][1])
-            self.graph_bottom_left = (graph_box['bottom_left'][0], graph_box['bottom_left'][1])
-            self.graph_bottom_right = (graph_box['bottom_right'][0], graph_box['bottom_right'][1])
-            if self.opened and self.signals: self.update_channels()
-            self.last_event = 'WINDOW_MOVED'
-        elif entry['event'] == 'GRAPH_RESIZED':
-            self.graph_width = data['graph_dimensions'][0]
-            self.graph_height = data['graph_dimensions'][1]
-            graph_box = data['graph_box']
-            self.graph_top_left = (graph_box['top_left'][0], graph_box['top_left'][1])
-            self.graph_top_right = (graph_box['top_right'][0], graph_box['top_right'][1])
-            self.graph_bottom_left = (graph_box['bottom_left'][0], graph_box['bottom_left'][1])
-            self.graph_bottom_right = (graph_box['bottom_right'][0], graph_box['bottom_right'][1])
-            if self.opened and self.signals: self.update_channels()
-            self.last_event = 'GRAPH_RESIZED'
-        elif event == 'MODAL_OPENED':
-            self.last_event = 'MODAL_OPENED'
-        elif event == 'MODAL_CLOSED':
-            self.last_event = 'MODAL_CLOSED'
-        elif event == 'MENU_OPENED':
-            self.last_event = 'MENU_OPENED'
-        elif event == 'MENU_SEARCH':
-            self.last_event = 'MENU_SEARCH'
-        elif event == 'MENU_CLOSED':
-            self.last_event = 'MENU_CLOSED'
-        elif event == 'WINDOW_MINIMISED':
-            self.last_event = 'WINDOW_MINIMISED'
-        elif event == 'WINDOW_MAXIMISED':
-            self.last_event = 'WINDOW_MAXIMISED'
-        elif event == 'WINDOW_OPENED':
-            self.last_event = 'WINDOW_OPENED'
-        elif event == 'WINDOW_FULLSCREEN':
-            self.last_event = 'WINDOW_FULLSCREEN'
-        else:
-            print("Invalid event!")
+        if CHANNEL_DATA in self.dirty and self.opened and self.signals:
+            if self.edf is None:
+                self.open_edf()
+            self.update_channels()
+        if BASELINES in self.dirty:
+            self.update_baselines()
+        self.dirty.clear()
+
+    def on_file_opened(self, data):
+        self.edf_file_path = data['edf_path']
+        self.time_position = data['time']
+        self.time_scale = data['time_scale']
+        self.set_graph_dimensions(data['graph_dimensions'])
+        self.set_graph_box(data['graph_box'])
+        self.montage_file_name = data['montage_file']
+        # The edf is opened when its signals are first drawn, so following the view alone never reads it
+        self.edf = None
+        self.dirty.update((CHANNELS, CHANNEL_DATA))
+        self.opened = True
+
+    def open_edf(self):
+        """
+        Open the edf from the last FILE_OPENED event, called by refresh() the first time its signals are needed. The
+        recorded path is remapped if it was recorded on another machine, and if it still can not be found the user is
+        asked for it, unless the state is not interactive.
+        """
+        print("Reading edf file")
+        path = self.edf_paths.get(self.edf_file_path) or resolve_edf_path(self.edf_file_path, self.path_map)
+        if path is None:
+            if not self.interactive:
+                raise FileNotFoundError(f"The path to the edf file ({self.edf_file_path}) is invalid")
+            user_input = input(f"The path to the edf file ({self.edf_file_path}) is invalid. Please specify the path"
+                               f"to the edf file. ")
+            assert os.path.exists(user_input), f"The path {user_input} does not lead to a valid edf file."
+            path = user_input
+        self.edf_paths[self.edf_file_path] = path
+        self.edf = EDFreader(path)
+        assert self.edf is not None
+        self.channel_buffer.reset()
+        self.channel_window = None
+
+    def on_file_closed(self, data):
+        return False
+
+    def on_montage_changed(self, data):
+        self.montage_file_name = data['montage_file']
+        self.time_scale = data['time']
+        self.dirty.add(CHANNELS)
+
+    def on_montage_file(self, data):
+        self.montage_file_name = data['montage_file']
+        self.dirty.add(CHANNELS)
+
+    def on_timescale_changed(self, data):
+        self.time_scale = data['time_scale']
+        self.time_position = data['time']
+        self.dirty.add(CHANNEL_DATA)
+
+    def on_time_position_changed(self, data):
+        self.time_position = data['time']
+        self.dirty.add(CHANNEL_DATA)
+
+    def on_zoom_changed(self, data):
+        self.montage_file_name = data['montage_file']
+        self.time_scale = data['time_scale']
+        self.time_position = data['time']
+        self.dirty.add(CHANNELS)
+
+    def on_window_moved(self, data):
+        self.set_graph_box(data['graph_box'])
+        # Only the screen geometry changed, the signals are projected onto the new box when drawn
+        self.dirty.add(BASELINES)
+
+    def on_graph_resized(self, data):
+        self.set_graph_dimensions(data['graph_dimensions'])
+        self.set_graph_box(data['graph_box'])
+        # Only the screen geometry changed, the signals are projected onto the new box when drawn
+        self.dirty.add(BASELINES)
+
+    def on_view_changed(self, data):
+        # Menus, modals and the window state only affect whether the graph is visible, see draw()
+        pass
+
+    def set_graph_dimensions(self, graph_dimensions):
+        self.graph_width = graph_dimensions[0]
+        self.graph_height = graph_dimensions[1]
+
+    def set_graph_box(self, graph_box):
+        self.graph_top_left = (graph_box['top_left'][0], graph_box['top_left'][1])
+        self.graph_top_right = (graph_box['top_right'][0], graph_box['top_right'][1])
+        self.graph_bottom_left = (graph_box['bottom_left'][0], graph_box['bottom_left'][1])
+        self.graph_bottom_right = (graph_box['bottom_right'][0], graph_box['bottom_right'][1])
 
     def load_channels_from_montage(self):
         """
@@ -191,143 +278,123 @@ class UIState:
             self.montage_file_path = os.path.join(self.montages_directory, self.montage_file_name)
             assert os.path.exists(self.montage_file_path)
 
-            # .mtg files can be parsed like XML
-            doc = etree.parse(self.montage_file_path)
-
-            # Need to know time and scale to correct data from edf
-            time_position = self.time_position_to_seconds()
-            time_scale = self.timescale_to_seconds()
-
-            # Parse and read in the channels from the mtg file
-            signals = doc.xpath('signalcomposition')
-            self.channels.clear()
-            for i, signal in enumerate(signals):
-                idx = i
-                label = signal.xpath('signal/label')
-                factor = signal.xpath('signal/factor')
-                voltpercm = signal.xpath('voltpercm')
-                screen_offset = signal.xpath('screen_offset')
-                polarity = signal.xpath('polarity')
-                filter_cnt = signal.xpath('filter_cnt')
-                self.channels.append(Channel(idx, label[0].text, factor[0].text, voltpercm[0].text, screen_offset[0].text, polarity[0].text, filter_cnt[0].text))
-
-                # Channel filters
-                filters = signal.xpath('fidfilter')
-                if len(filters) > 0:
-                    for f in filters:
-                        ftype = f.xpath('type')
-                        freq_1 = f.xpath('frequency')
-                        freq_2 = f.xpath('frequency2')
-                        ripple = f.xpath('ripple')
-                        order = f.xpath('order')
-                        model = f.xpath('model')
-                        self.channels[i].fid_filters.append(FidFilter(ftype[0].text, freq_1[0].text, freq_2[0].text, ripple[0].text, order[0].text, model[0].text))
-
-                # Update the channel baseline
-                self.channels[i].update_baseline(self.graph_height, len(self.channels), self.graph_top_left[1])
-
-                # Load the corresponding signal data from the edf
-                if self.signals:
-                    self.update_channel_data(i, self.channels[i], time_position, time_scale)
+            # Montages are parsed once per distinct file content and shared through the cache
+            montage = self.montage_cache.load(self.montage_file_path)
+
+            # The new channels need their baselines laid out and their signal data loaded from the edf
+            self.channels = montage.build_channels()
+            self.dirty.update((BASELINES, CHANNEL_DATA))
+
+    def get_baselines(self):
+        """
+        The baselines only move when the graph is moved or resized or the montage changes, so keep the layout cached
+        until one of those events invalidates it.
+        :return: A numpy array with the vertical screen position of each channel baseline
+        """
+        self.refresh()
+        return self.baselines
+
+    def update_baselines(self):
+        """
+        Lay out the baselines for all the channels at once. The channels are spaced evenly down the graph and then
+        shifted by their screen offset from the montage.
+        """
+        if len(self.channels) == 0:
+            self.baselines = numpy.empty(0, dtype=numpy.int64)
+            return
+        step = self.graph_height / (len(self.channels) + 1)
+        ids = numpy.array([channel.id for channel in self.channels], dtype=numpy.int64)
+        offsets = numpy.array([float(channel.screen_offset) for channel in self.channels]).astype(numpy.int64)
+        self.baselines = (step + ids * int(step) + int(self.graph_top_left[1]) + offsets).astype(numpy.int64)
+        for channel, baseline in zip(self.channels, self.baselines):
+            channel.baseline = int(baseline)
 
     def update_channels(self):
+        """
+        Bring the current page of every channel into the channel buffer. Nothing is read if the time window is the one
+        already held, and when the page has only scrolled part of the way just the newly exposed samples are read.
+        """
         time_position = self.time_position_to_seconds()
         time_scale = self.timescale_to_seconds()
+        window = (time_position, time_scale, len(self.channels))
+        if window != self.channel_window:
+            lengths = [int(self.edf.getSampleFrequency(i) * time_scale) for i in range(len(self.channels))]
+            self.channel_buffer.allocate(lengths)
+            for i in range(len(self.channels)):
+                sample_position = int(self.edf.getSampleFrequency(i) * time_position)
+                self.channel_buffer.move(i, sample_position, lambda start, out: self.read_samples(i, start, out))
+            self.channel_window = window
         for i, channel in enumerate(self.channels):
-            self.update_channel_data(i, channel, time_position, time_scale)
+            channel.data = self.channel_buffer.view(i)
 
-    def update_channel_data(self, i, channel, time_position, time_scale):
+    def read_samples(self, i, start, out):
         """
-        Reconstruct the signals for the current state.
-        :return:
+        Read samples of a signal from the edf. Anything before the start or after the end of the recording is left as
+        nan.
+        :param i: The signal index
+        :param start: The first sample to read, may be negative
+        :param out: The array to fill, its size is the number of samples read
+        """
+        out[:] = numpy.nan
+        first = max(start, 0)
+        stop = min(start + out.size, self.edf.getTotalSamples(i))
+        if stop > first:
+            self.edf.fseek(i, first, 0)
+            self.edf.readSamples(i, out[first - start:], stop - first)
+
+    @property
+    def time_position(self):
+        return self._time_position
+
+    @time_position.setter
+    def time_position(self, time_position):
+        """
+        The time position only changes on UI events, so convert it to seconds once here rather than on every sample
         """
+        self._time_position = time_position
+        self.time_position_seconds = None
+        if time_position is not None:
+            try:
+                self.time_position_seconds = time_position_to_seconds(time_position)
+            except ValueError:
+                print(f"Could not read the time position {time_position}")
 
-        edf_seconds = int(self.edf.getTotalSamples(i) / self.edf.getSampleFrequency(i))
-        sample_position = int(self.edf.getSampleFrequency(i) * time_position)
-        samples_to_read = int(self.edf.getSampleFrequency(i) * time_scale)
-        buffer_seconds = int(samples_to_read / self.edf.getSampleFrequency(i))
-        channel.data = numpy.empty(samples_to_read, dtype=numpy.float_)
-        if samples_to_read > 1:
-            if time_position + buffer_seconds < 0:
-                channel.data[0:samples_to_read] = numpy.nan
-            elif time_position < 0:
-                self.edf.fseek(i, 0, 0)
-                self.edf.readSamples(i, channel.data, samples_to_read)
-                channel.data = numpy.roll(channel.data, (sample_position*-1))
-                channel.data[0:(sample_position*-1)] = numpy.nan
-            elif time_position + buffer_seconds > edf_seconds:
-                seconds_over = (time_position + buffer_seconds) - edf_seconds
-                samples_over = self.edf.getSampleFrequency(i) * seconds_over
-                self.edf.fseek(i, sample_position, 0)
-                self.edf.readSamples(i, channel.data, samples_over)
-                #channel.data = numpy.roll(channel.data, (seconds_over * -1))
-                channel.data[int(samples_over):int(samples_to_read)] = numpy.nan
-            elif time_position >= edf_seconds:
-                channel.data[0:samples_to_read] = numpy.nan
-            else:
-                self.edf.fseek(i, sample_position, 0)
-                self.edf.readSamples(i, channel.data, samples_to_read)
+    @property
+    def time_scale(self):
+        return self._time_scale
+
+    @time_scale.setter
+    def time_scale(self, time_scale):
+        """
+        The timescale only changes on UI events, so convert it to seconds once here rather than on every sample
+        """
+        self._time_scale = time_scale
+        self.time_scale_seconds = None
+        if time_scale is not None:
+            try:
+                self.time_scale_seconds = timescale_to_seconds(time_scale)
+            except ValueError:
+                print(f"Could not read the timescale {time_scale}, try a different format")
 
     def time_position_to_seconds(self):
         """
-        Convert the recorded time string in the log
-        :return: An int describing the time in seconds
-        """
-        try:
-            x = self.time_position.split('(')[1].strip(')')
-            x = datetime.strptime(x, '%H:%M:%S')
-            return x.second + x.minute * 60 + x.hour * 3600
-        except ValueError:
-            pass
-        try:
-            x = self.time_position.split('(')[1].strip(')')
-            x = datetime.strptime(x, '%H:%M:%S.%f')
-            return x.second + x.minute * 60 + x.hour * 3600
-        except ValueError:
-            pass
-        try:
-            x = self.time_position.split('(')[1].strip(')')
-            x = datetime.strptime(x, '-%H:%M:%S')
-            return x.second + x.minute * 60 + x.hour * 3600
-        except ValueError:
-            pass
-        x = self.time_position.split('(')[1].strip(')')
-        x = datetime.strptime(x, '-%H:%M:%S.%f')
-        return x.second + x.minute * 60 + x.hour * 3600
+        :return: The current time position in seconds, including any fraction of a second
+        """
+        return self.time_position_seconds
 
     def time_position_to_samples(self, channel):
-        x = self.time_position.split('(')[1].strip(')')
-        x = time.strptime(x, '%H:%M:%S')
-        total_seconds = x.tm_sec + x.tm_min * 60 + x.tm_hour * 3600
-        return self.edf.getSampleFrequency(channel) * total_seconds
+        return self.edf.getSampleFrequency(channel) * self.time_position_seconds
 
     def timescale_to_seconds(self):
         """
-        The timescale is recorded from EDFBrowser as a string e.g. 10 sec.
-        Change to seconds to perform calculations
-        :return: an int describing a number of seconds
-        """
-        if "uS" in self.time_scale:
-            split = self.time_scale.strip("uS")
-            return float(split) / 1000000
-        elif "mS" in self.time_scale:
-            split = self.time_scale.strip("mS")
-            return float(split) / 1000
-        elif "sec" in self.time_scale:
-            split = self.time_scale.strip(" sec")
-            return float(split)
-        else:
-            try:
-                pt = datetime.strptime(self.time_scale, '%H:%M:%S')
-                return pt.second + pt.minute * 60 + pt.hour * 3600
-            except ValueError:
-                try:
-                    pt = datetime.strptime(self.time_scale, '%M:%S')
-                    return pt.second + pt.minute * 60 + pt.hour * 3600
-                except ValueError:
-                    print("Try a different format")
+        :return: The current timescale in seconds
+        """
+        return self.time_scale_seconds
 
     def draw(self, image):
+        load_cv2()
+        self.font_type = cv2.FONT_HERSHEY_PLAIN
+        self.refresh()
         if not (self.last_event == "MENU_OPENED" or self.last_event == "MENU_SEARCH" or self.last_event == "MENU_CLOSED" or self.last_event == "MODAL_OPENED" or self.last_event == "MODAL_CLOSED" or self.last_event == "WINDOW_MINIMISED"):
             image = self.draw_graph_bbox(image)
             image = self.draw_channel_baselines(image)
@@ -385,10 +452,8 @@ class UIState:
         """
         graph_left = self.graph_top_left[0]
         graph_right = self.graph_top_right[0]
-        graph_top = self.graph_top_left[1]
-        for i, channel in enumerate(self.channels):
-            channel.update_baseline(self.graph_height, len(self.channels), graph_top)
-            image = cv2.line(image, (graph_left, channel.baseline), (graph_right, channel.baseline), self.line_color, self.line_width)
+        for baseline in self.get_baselines().tolist():
+            image = cv2.line(image, (graph_left, baseline), (graph_right, baseline), self.line_color, self.line_width)
         return image
 
     def draw_channel_signals(self, image):
@@ -398,43 +463,92 @@ class UIState:
         :param image: The corresponding screenshot to this current log
         :return: An image with the EEG data traced over the top
         """
+        segments = self.project_signals()
+        if len(segments) > 0:
+            image = cv2.polylines(image, segments, False, (255, 0, 0), 1)
+        return image
+
+    def project_signals(self):
+        """
+        Convert the samples of every channel to screen coordinates in one go over the channel buffer. Each channel is
+        spread across the graph width and scaled around its baseline.
+
+        On long pages there are many more samples than the graph has pixel columns, so the samples falling in each
+        column are reduced to the first, lowest, highest and last. Within a column these draw a vertical line over
+        the same range as all the samples would and join up with the neighbouring columns in the same place, so the
+        trace looks the same but costs at most four points per column whatever the timescale.
+        :return: A list of int32 (n, 2) point arrays, one for each unbroken run of samples. Runs are split wherever the
+                 data is nan e.g. before the start of the recording, and never cross from one channel to the next
+        """
+        buffer = self.channel_buffer
+        lengths = buffer.lengths
+        num_samples = int(lengths.sum())
+        if num_samples == 0:
+            return []
+        data = buffer.pages()
+        offsets = buffer.page_offsets()
 
         # Scale is recorded in EDFBrowser as Volts per CM. So we need to find out our scale from pixels per inch to
         # pixels per cm
         dpi = 72  # this might need to change depending on what screen it was recorded on??
         ppc = dpi * 2.54
 
-        tasks = []
-        for channel in self.channels:
-            tasks.append((self.graph_width, self.graph_top_left[0], ppc, channel))
-
-        results = self.pool.starmap(self.draw_signal, tasks)
-        for i in range(len(results)):
-            if results[i] is not None:
-                for j in range(len(results[i])-2):
-                    image = cv2.line(image, (results[i][j][0], results[i][j][1]), (results[i][j+1][0], results[i][j+1][1]), (255, 0, 0), 1)
-
-        return image
-
-    @staticmethod
-    def draw_signal(graph_width, graph_left, ppc, channel):
-        if isinstance(channel.data, numpy.ndarray):
-            num_samples = channel.data.size
-            if num_samples > 0:
-                arr = numpy.empty((num_samples, 2), dtype=numpy.int)
-                spacing = graph_width / num_samples
-                for point in range(channel.data.size - 1):
-                    if not math.isnan(channel.data[point]):
-                        # Yc = s * Yr + o
-                        x = int(int(point * spacing) + graph_left)
-                        y = int((((float(channel.voltspercm) / ppc) * channel.data[point]) * -1) + channel.baseline)
-                        arr[point][0] = x
-                        arr[point][1] = y
-                return arr
-
-    @staticmethod
-    def init(l):
-        global lock
-        lock = l
-
-
+        # The pixel column of every sample, relative to the left of the graph
+        spacing = self.graph_width / numpy.maximum(lengths, 1)
+        point = numpy.arange(num_samples) - numpy.repeat(offsets, lengths)
+        columns = (point * numpy.repeat(spacing, lengths)).astype(numpy.int64)
+        valid = ~numpy.isnan(data)
+
+        # A new run starts at the start of each channel and wherever the data goes to or from nan
+        run_start = numpy.zeros(num_samples, dtype=bool)
+        run_start[offsets[lengths > 0]] = True
+        run_start[1:] |= valid[1:] != valid[:-1]
+
+        scale = numpy.array([float(c.voltspercm) / ppc for c in self.channels])
+        baselines = self.get_baselines()
+        if num_samples <= self.decimate_ratio * self.graph_width * len(lengths):
+            # Short pages have few samples per column so project every sample, Yc = s * Yr + o
+            points = numpy.empty((num_samples, 2), dtype=numpy.int32)
+            points[:, 0] = columns + self.graph_top_left[0]
+            y = ((numpy.repeat(scale, lengths) * data) * -1) + numpy.repeat(baselines, lengths)
+            points[valid, 1] = y[valid].astype(numpy.int64)
+            starts = numpy.flatnonzero(run_start)
+            stops = numpy.append(starts[1:], num_samples)
+            return [points[start:stop] for start, stop in zip(starts.tolist(), stops.tolist())
+                    if valid[start] and stop - start > 1]
+
+        # Group the samples by column and keep only the groups with data
+        group_start = run_start.copy()
+        group_start[1:] |= columns[1:] != columns[:-1]
+        starts = numpy.flatnonzero(group_start)
+        stops = numpy.append(starts[1:], num_samples)
+        lowest = numpy.minimum.reduceat(data, starts)
+        highest = numpy.maximum.reduceat(data, starts)
+        keep = valid[starts]
+        starts, stops, lowest, highest = starts[keep], stops[keep], lowest[keep], highest[keep]
+
+        # Only keep the lowest and highest if they are not already the first or last
+        first = data[starts]
+        last = data[stops - 1]
+        values = numpy.stack((first, lowest, highest, last), axis=1)
+        used = numpy.empty(values.shape, dtype=bool)
+        used[:, 0] = True
+        used[:, 1] = (lowest != first) & (lowest != last)
+        used[:, 2] = (highest != first) & (highest != last)
+        used[:, 3] = stops - starts > 1
+        values = values[used]
+        counts = used.sum(axis=1)
+
+        # Yc = s * Yr + o
+        groups_per_channel = numpy.bincount(numpy.searchsorted(offsets, starts, side='right') - 1,
+                                            minlength=len(lengths))
+        points = numpy.empty((len(values), 2), dtype=numpy.int32)
+        points[:, 0] = numpy.repeat(columns[starts] + self.graph_top_left[0], counts)
+        points[:, 1] = ((numpy.repeat(numpy.repeat(scale, groups_per_channel), counts) * values) * -1 +
+                        numpy.repeat(numpy.repeat(baselines, groups_per_channel), counts)).astype(numpy.int64)
+
+        # Split the points back into runs
+        first_point = numpy.cumsum(counts) - counts
+        breaks = first_point[run_start[starts]]
+        ends = numpy.append(breaks[1:], len(points))
+        return [points[start:stop] for start, stop in zip(breaks.tolist(), ends.tolist()) if stop - start > 1]
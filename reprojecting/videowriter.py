@@ -0,0 +1,112 @@
+import queue
+import threading
+
+import cv2
+import numpy
+
+# The codecs stock OpenCV builds can write, by name: (fourcc, container extension). mp4v and XVID are several times
+# smaller than MJPG and quicker to encode, MJPG keeps every frame as a separate jpeg
+CODECS = {
+    'mp4v': ('mp4v', '.mp4'),
+    'xvid': ('XVID', '.avi'),
+    'mjpg': ('MJPG', '.avi'),
+}
+
+
+class VideoWriterThread:
+
+    def __init__(self, path, fourcc, fps, size, queue_size=8, scale=1.0):
+        """
+        Encodes video frames on a separate thread so the encoding overlaps the parsing and drawing of the next frames.
+        Frames are copied into a fixed set of buffers that are handed to the thread through a bounded queue, so the
+        caller may keep drawing over its own frame straight away. When the encoder falls behind, write blocks until a
+        buffer is free rather than letting frames pile up in memory. cv2 releases the GIL while encoding, so a thread
+        is enough to use another core.
+        :param path: The video file to write
+        :param fourcc: The cv2 fourcc code of the codec
+        :param fps: The frame rate of the video
+        :param size: The (width, height) of the frames
+        :param queue_size: The most frames waiting to be encoded
+        :param scale: Shrink the frames by this factor before encoding them, on the writer thread
+        """
+        self.scale = scale
+        self.size = size
+        if self.scale != 1.0:
+            # Most codecs need even dimensions
+            self.size = (max(2, int(size[0] * scale) // 2 * 2), max(2, int(size[1] * scale) // 2 * 2))
+        self.writer = cv2.VideoWriter(path, fourcc, fps, self.size)
+        if not self.writer.isOpened():
+            raise RuntimeError(f"Could not open a video writer for {path}, the codec may not be in this OpenCV build")
+        self.frames = queue.Queue(maxsize=queue_size)
+        # One buffer more than the queue holds is being encoded, and another is being filled by write
+        self.free = queue.Queue()
+        self.num_buffers = queue_size + 2
+        self.allocated = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="video writer", daemon=True)
+        self.thread.start()
+
+    def write(self, frame):
+        """
+        Queue a copy of a frame to be encoded, waiting for the encoder if the queue is full
+        :param frame: The frame to write, it may be changed as soon as this returns
+        """
+        self.check()
+        buffer = self.buffer(frame)
+        buffer[...] = frame
+        self.frames.put(buffer)
+
+    def buffer(self, frame):
+        """
+        :param frame: The frame that will be copied into the buffer
+        :return: A free buffer the size of the frame, allocating one while there are fewer than num_buffers
+        """
+        while True:
+            try:
+                if self.allocated < self.num_buffers:
+                    buffer = self.free.get_nowait()
+                else:
+                    buffer = self.free.get(timeout=1)
+            except queue.Empty:
+                if self.allocated < self.num_buffers:
+                    self.allocated += 1
+                    return numpy.empty_like(frame)
+                # Still waiting on the encoder, make sure it hasn't stopped
+                self.check()
+                continue
+            if buffer.shape == frame.shape and buffer.dtype == frame.dtype:
+                return buffer
+            self.allocated -= 1
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    self.writer.write(self.resize(frame))
+                except Exception as e:
+                    # Keep draining the queue so write never blocks forever, the error is raised on the caller's thread
+                    self.error = e
+            self.free.put(frame)
+
+    def resize(self, frame):
+        if self.scale == 1.0:
+            return frame
+        return cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("The video writer stopped") from self.error
+
+    def release(self):
+        """
+        Wait for the queued frames to be encoded then close the video file
+        """
+        if self.thread is not None:
+            self.frames.put(None)
+            self.thread.join()
+            self.thread = None
+            self.writer.release()
+        self.check()